@@ -0,0 +1,73 @@
+import os
+import time
+import tempfile
+
+from typing import Any, Dict, List
+
+from dataflow.stream import CsvReadStream, CsvWriteStream
+
+from common import result, print_results
+
+
+def write_csv(filename: str, n: int, cols: int = 8):
+    with open(filename, 'w') as f:
+        f.write(','.join('col{}'.format(i) for i in range(cols)) + '\n')
+        for i in range(n):
+            f.write(','.join(str(i * cols + j) for j in range(cols)) + '\n')
+
+
+def read_rate(filename: str, **kwargs) -> float:
+    start = time.perf_counter()
+    with CsvReadStream(filename, **kwargs) as ins:
+        n = sum(1 for _ in ins.iter_items())
+    return n / (time.perf_counter() - start)
+
+
+def write_rate(filename: str, n: int, cols: int = 8, **kwargs) -> float:
+    names = ['col{}'.format(i) for i in range(cols)]
+    items = [{name: i * cols + j for j, name in enumerate(names)} for i in range(n)]
+
+    start = time.perf_counter()
+    with CsvWriteStream(filename, names, **kwargs) as ous:
+        for item in items:
+            ous.put_item(item)
+    return n / (time.perf_counter() - start)
+
+
+def run(scale: float = 1.0) -> List[Dict[str, Any]]:
+    n = max(int(300000 * scale), 1000)
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'bench.csv')
+        write_csv(filename, n)
+
+        results.append(result('csv', 'read regex', 'rows_per_sec', read_rate(filename, engine='regex'),
+                              engine='regex', rows=n))
+        for buffer_size in (8 * 1024, 1024 * 1024):
+            rate = read_rate(filename, engine='csv', buffer_size=buffer_size)
+            results.append(result('csv', 'read csv, {} KiB buffer'.format(buffer_size // 1024), 'rows_per_sec',
+                                  rate, engine='csv', buffer_size=buffer_size, rows=n))
+
+        out = os.path.join(folder, 'out.csv')
+        for max_buf_size in (20, 1000):
+            rate = write_rate(out, n, max_buf_size=max_buf_size)
+            results.append(result('csv', 'write, {} rows buffer'.format(max_buf_size), 'rows_per_sec', rate,
+                                  max_buf_size=max_buf_size, rows=n))
+        rate = write_rate(out, n, max_buf_bytes=1024 * 1024)
+        results.append(result('csv', 'write, 1024 KiB buffer', 'rows_per_sec', rate,
+                              max_buf_bytes=1024 * 1024, rows=n))
+
+        # compressed in background threads, against the plain file above
+        for ext in ('.gz', '.bz2', '.xz'):
+            out = os.path.join(folder, 'out.csv' + ext)
+            rate = write_rate(out, n, max_buf_bytes=1024 * 1024)
+            results.append(result('csv', 'write {}'.format(ext), 'rows_per_sec', rate, compression=ext, rows=n))
+            rate = read_rate(out, engine='csv')
+            results.append(result('csv', 'read csv {}'.format(ext), 'rows_per_sec', rate, compression=ext, rows=n))
+
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
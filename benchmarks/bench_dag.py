@@ -0,0 +1,38 @@
+from typing import Any, Dict, List
+
+import dataflow as dflow
+
+from common import timeit, result, print_results
+
+
+# `depth` layers of `width` factories; every factory reads two neighbours of
+# the previous layer, and one last factory sums the final layer.
+def build_flow(depth: int, width: int) -> dflow.DataFlow:
+    flow = dflow.DataFlow()
+
+    for layer in range(1, depth + 1):
+        for j in range(width):
+            requires = ['f{}_{}'.format(layer - 1, j), 'f{}_{}'.format(layer - 1, (j + 1) % width)]
+            # every factory needs its own function, operations are looked up by it
+            flow.append_factory(requires, 'f{}_{}'.format(layer, j), lambda x, y: x + y)
+
+    flow.append_factory(['f{}_{}'.format(depth, j) for j in range(width)], 'out', lambda *xs: sum(xs))
+    return flow
+
+
+def run(scale: float = 1.0) -> List[Dict[str, Any]]:
+    results = []
+    for depth, width in ((4, 4), (16, 4), (4, 16), (16, 16), (64, 8)):
+        pipe = dflow.SerialPipeline(build_flow(depth, width))
+        inputs = {'f0_{}'.format(j): j for j in range(width)}
+        n = max(int(20000 * scale / (depth * width)), 10)
+
+        pipe.product('out', inputs)
+        per_item = timeit(lambda: pipe.product('out', inputs), n)
+        results.append(result('dag', 'depth={} width={}'.format(depth, width), 'us_per_item', per_item * 1e6,
+                              depth=depth, width=width, ops=depth * width + 1))
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
@@ -0,0 +1,86 @@
+import os
+import time
+import tempfile
+import itertools
+
+from typing import Any, Dict, List
+
+import dataflow as dflow
+
+from dataflow.stream import CsvWriteStream
+
+from common import RangeInStream, NullOutStream, result, print_results
+
+
+def build_flow(work: int = 0):
+    flow = dflow.DataFlow()
+    flow.const['work'] = work
+
+    @flow.factory(requires=['a', 'b'], provides='c', require_const='work')
+    def multiply(a, b, work):
+        # some cpu work per row so more workers have something to scale
+        for _ in range(work):
+            a = (a * 31 + b) % 1000003
+        return a * b
+
+    return flow
+
+
+def rows_per_sec(flow: dflow.DataFlow, n: int, keep_order: bool, **kwargs) -> float:
+    producer = dflow.ParallelProducer(**kwargs)
+
+    start = time.perf_counter()
+    producer.produce(flow, RangeInStream(n), NullOutStream(['c']), keep_order=keep_order)
+    return n / (time.perf_counter() - start)
+
+
+# many small runs, where starting the workers is most of the cost
+def runs_per_sec(flow: dflow.DataFlow, runs: int, rows: int, persistent: bool) -> float:
+    with dflow.ParallelProducer(num_workers=2, persistent=persistent) as producer:
+        start = time.perf_counter()
+        for _ in range(runs):
+            producer.produce(flow, RangeInStream(rows), NullOutStream(['c']))
+        return runs / (time.perf_counter() - start)
+
+
+def run(scale: float = 1.0) -> List[Dict[str, Any]]:
+    n = max(int(100000 * scale), 1000)
+    results = []
+
+    # scaling over worker counts, with rows that cost some cpu time
+    flow = build_flow(work=200)
+    for num_workers, keep_order in itertools.product((1, 2, 4, 8), (False, True)):
+        rate = rows_per_sec(flow, n // 4, keep_order, num_workers=num_workers)
+        results.append(result('producer', 'workers={} keep_order={}'.format(num_workers, keep_order),
+                              'rows_per_sec', rate, num_workers=num_workers, keep_order=keep_order))
+
+    # overhead per chunk, with rows that cost next to nothing
+    flow = build_flow()
+    for num_workers, chunk_size in itertools.product((1, 4), (1, 16, 256, 0)):
+        rate = rows_per_sec(flow, n, True, num_workers=num_workers, chunk_size=chunk_size)
+        results.append(result('producer', 'workers={} chunk={}'.format(num_workers, chunk_size or 'auto'),
+                              'rows_per_sec', rate, num_workers=num_workers, chunk_size=chunk_size))
+
+    # cheap rows with wide string columns, so formatting them is the ceiling
+    with tempfile.TemporaryDirectory() as folder:
+        out = os.path.join(folder, 'out.csv')
+        for num_writers in (1, 2, 4):
+            start = time.perf_counter()
+            dflow.ParallelProducer(num_workers=4, num_writers=num_writers).produce(
+                build_flow(), RangeInStream(n), CsvWriteStream(out, ['a', 'b', 'c'], max_buf_bytes=1024 * 1024))
+            rate = n / (time.perf_counter() - start)
+            results.append(result('producer', 'csv writers={}'.format(num_writers), 'rows_per_sec', rate,
+                                  num_writers=num_writers))
+
+    flow = build_flow().freeze()
+    runs = max(int(200 * scale), 20)
+    for persistent in (False, True):
+        rate = runs_per_sec(flow, runs, 100, persistent)
+        results.append(result('producer', 'small runs persistent={}'.format(persistent),
+                              'runs_per_sec', rate, persistent=persistent))
+
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
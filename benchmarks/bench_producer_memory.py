@@ -0,0 +1,66 @@
+import time
+import resource
+import multiprocessing as mp
+
+from typing import Any, Dict, List
+
+import dataflow as dflow
+
+from common import NullOutStream, result, print_results
+
+
+class PayloadInStream(dflow.InStream):
+    def __init__(self, n: int, payload_size: int):
+        self._n = n
+        self._payload = 'x' * payload_size
+
+    def iter_items(self):
+        for i in range(self._n):
+            yield dict(a=i, payload=self._payload)
+
+
+def build_flow():
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires=['a', 'payload'], provides='b')
+    def slow_head(a, payload):
+        # one straggler at the head forces keep_order to buffer everything behind it
+        if a == 0:
+            time.sleep(2)
+        return payload.upper()
+
+    return flow
+
+
+def _run(n, payload_size, kwargs, out):
+    producer = dflow.ParallelProducer(num_workers=4, chunk_size=16, **kwargs)
+    start = time.perf_counter()
+    producer.produce(build_flow(), PayloadInStream(n, payload_size), NullOutStream(['b']),
+                     keep_order=True)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is the peak of the largest single child, in KiB on Linux
+    out.put((elapsed, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+
+def run(scale: float = 1.0, payload_size: int = 4096) -> List[Dict[str, Any]]:
+    n = max(int(50000 * scale), 1000)
+    configs = [
+        ('unbounded', dict(max_queue_size=100000)),
+        ('bounded queues', dict()),
+        ('bounded + window', dict(reorder_window=1024)),
+    ]
+
+    results = []
+    for name, kwargs in configs:
+        out = mp.Queue()
+        p = mp.Process(target=_run, args=(n, payload_size, kwargs, out))
+        p.start()
+        elapsed, peak = out.get()
+        p.join()
+        results.append(result('producer_memory', name, 'peak_rss_mib', peak / 1024, seconds=elapsed, **kwargs))
+
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
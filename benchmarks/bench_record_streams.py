@@ -0,0 +1,51 @@
+import os
+import time
+import tempfile
+
+from typing import Any, Dict, List
+
+from dataflow.stream import CsvReadStream, CsvWriteStream, RecordReadStream, RecordWriteStream
+
+from common import result, print_results
+
+
+def round_trip(ous, ins, n: int):
+    start = time.perf_counter()
+    with ous:
+        for i in range(n):
+            ous.put_item(dict(a=i, b=i * 0.25, c='name-{}'.format(i)))
+    written = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ins:
+        count = sum(1 for _ in ins.iter_items())
+    read = time.perf_counter() - start
+
+    return n / written, count / read
+
+
+def run(scale: float = 1.0) -> List[Dict[str, Any]]:
+    n = max(int(300000 * scale), 1000)
+    cols = ['a', 'b', 'c']
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        csv_file = os.path.join(folder, 'data.csv')
+        rec_file = os.path.join(folder, 'data.rec')
+
+        formats = [
+            ('csv', csv_file, CsvWriteStream(csv_file, cols, max_buf_size=1000), CsvReadStream(csv_file, engine='csv')),
+            ('record', rec_file, RecordWriteStream(rec_file, cols), RecordReadStream(rec_file)),
+        ]
+
+        for name, filename, ous, ins in formats:
+            write_rate, read_rate = round_trip(ous, ins, n)
+            size = os.path.getsize(filename) / 2 ** 20
+            results.append(result('records', name + ' write', 'rows_per_sec', write_rate, format=name, mib=size))
+            results.append(result('records', name + ' read', 'rows_per_sec', read_rate, format=name, mib=size))
+
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
@@ -0,0 +1,36 @@
+from typing import Any, Dict, List
+
+import dataflow as dflow
+
+from common import timeit, result, print_results
+from bench_dag import build_flow
+
+
+def run(scale: float = 1.0) -> List[Dict[str, Any]]:
+    depth, width = 32, 8
+    inputs = {'f0_{}'.format(j): j for j in range(width)}
+    targets = {'out'}
+    n = max(int(2000 * scale), 10)
+
+    results = []
+    for frozen in (False, True):
+        flow = build_flow(depth, width)
+        if frozen:
+            flow.freeze()
+        pipe = dflow.SerialPipeline(flow)
+        case = 'frozen' if frozen else 'unfrozen'
+
+        def miss():
+            pipe._cache_for_route.clear()
+            pipe._get_plan(targets, inputs.keys())
+
+        results.append(result('route_cache', case + ' miss', 'us_per_lookup',
+                              timeit(miss, max(n // 10, 1)) * 1e6, frozen=frozen, ops=depth * width + 1))
+        results.append(result('route_cache', case + ' hit', 'us_per_lookup',
+                              timeit(lambda: pipe._get_plan(targets, inputs.keys()), n * 50) * 1e6,
+                              frozen=frozen, ops=depth * width + 1))
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
@@ -0,0 +1,57 @@
+from typing import Any, Dict, List
+
+import dataflow as dflow
+
+from common import timeit, result, print_results
+
+
+def build_flow():
+    flow = dflow.DataFlow()
+    flow.const['scale'] = 3
+
+    @flow.filter('a')
+    def clip_a(a):
+        return a if a > 0 else 0
+
+    @flow.factory(requires=['a', 'b'], provides='e')
+    def multiply(a, b):
+        return a * b
+
+    @flow.factory(requires=['c', 'd'], provides='f')
+    def division(c, d):
+        return c / d
+
+    @flow.factory(requires=['e', 'f'], provides=['g', 'h'], require_const='scale')
+    def combine(e, f, scale):
+        return e + f, (e - f) * scale
+
+    @flow.factory(requires=['g', 'h'], provides='i')
+    def add(g, h):
+        return g + h
+
+    return flow
+
+
+def run(scale: float = 1.0) -> List[Dict[str, Any]]:
+    n = max(int(200000 * scale), 100)
+    flow = build_flow()
+    pipe = dflow.SerialPipeline(flow)
+    inputs = dict(a=1, b=2, c=3, d=4)
+    targets = ('i',)
+
+    _, route = pipe._get_route(set(targets), inputs.keys())
+    plan = pipe._get_plan(set(targets), inputs.keys())
+
+    interpreted = timeit(lambda: pipe._exec_chain(inputs, route), n)
+    compiled = timeit(lambda: plan(inputs), n)
+    product = timeit(lambda: pipe.product(targets, inputs), n)
+
+    return [
+        result('route_plan', 'interpreted _exec_chain', 'us_per_item', interpreted * 1e6),
+        result('route_plan', 'compiled plan', 'us_per_item', compiled * 1e6),
+        result('route_plan', 'product (with lookup)', 'us_per_item', product * 1e6),
+    ]
+
+
+if __name__ == '__main__':
+    print_results(run())
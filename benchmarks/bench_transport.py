@@ -0,0 +1,48 @@
+import time
+
+from typing import Any, Dict, List
+
+import dataflow as dflow
+
+from common import NullOutStream, result, print_results
+
+
+class BlobInStream(dflow.InStream):
+    def __init__(self, n: int, size: int):
+        self._n = n
+        self._size = size
+
+    def iter_items(self):
+        blob = b'\x01' * self._size
+        for i in range(self._n):
+            yield dict(i=i, blob=blob)
+
+
+def build_flow():
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires='blob', provides='out')
+    def passthrough(blob):
+        return blob
+
+    return flow
+
+
+def run(scale: float = 1.0, size: int = 4 * 1024 * 1024) -> List[Dict[str, Any]]:
+    n = max(int(2000 * scale), 20)
+    results = []
+    for name, transport in (('pickle', None), ('shm', dflow.SharedMemoryTransport())):
+        producer = dflow.ParallelProducer(num_workers=4, chunk_size=1, transport=transport)
+
+        start = time.perf_counter()
+        producer.produce(build_flow(), BlobInStream(n, size), NullOutStream(['out']))
+        elapsed = time.perf_counter() - start
+
+        results.append(result('transport', name, 'mib_per_sec', n * size / elapsed / 2 ** 20,
+                              transport=name, size=size))
+
+    return results
+
+
+if __name__ == '__main__':
+    print_results(run())
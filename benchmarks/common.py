@@ -0,0 +1,44 @@
+import time
+
+from typing import Any, Callable, Dict, List
+
+import dataflow as dflow
+
+
+class RangeInStream(dflow.InStream):
+    def __init__(self, n: int):
+        self._n = n
+
+    def iter_items(self):
+        for i in range(self._n):
+            yield dict(a=i, b=i + 1)
+
+
+class NullOutStream(dflow.OutStream):
+    def __init__(self, cols):
+        self._cols = cols
+
+    def put_item(self, item):
+        pass
+
+    @property
+    def requires(self):
+        return self._cols
+
+
+def timeit(fn: Callable, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+# One measurement: `value` of `metric` for a `case` of a benchmark, with the
+# parameters of the case kept so results can be filtered and compared.
+def result(benchmark: str, case: str, metric: str, value: float, **params) -> Dict[str, Any]:
+    return dict(benchmark=benchmark, case=case, metric=metric, value=value, params=params)
+
+
+def print_results(results: List[Dict[str, Any]]):
+    for r in results:
+        print('{:>16} {:>36} {:>14} {:>14.3f}'.format(r['benchmark'], r['case'], r['metric'], r['value']))
@@ -0,0 +1,101 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import multiprocessing as mp
+
+from typing import Any, Dict, List, Optional
+
+import bench_dag
+import bench_route_cache
+import bench_route_plan
+import bench_csv
+import bench_record_streams
+import bench_producer
+import bench_producer_memory
+import bench_transport
+
+from common import print_results
+
+
+SUITES = {
+    'dag': bench_dag,
+    'route_cache': bench_route_cache,
+    'route_plan': bench_route_plan,
+    'csv': bench_csv,
+    'records': bench_record_streams,
+    'producer': bench_producer,
+    'producer_memory': bench_producer_memory,
+    'transport': bench_transport,
+}
+
+# slow or memory hungry, only run when asked for by name
+OPTIONAL = {'producer_memory', 'transport'}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any]):
+    old = {(r['benchmark'], r['case'], r['metric']): r['value'] for r in baseline['results']}
+
+    print('{:>16} {:>36} {:>14} {:>14} {:>14} {:>8}'.format('benchmark', 'case', 'metric', 'baseline', 'value', 'change'))
+    for r in results:
+        before = old.get((r['benchmark'], r['case'], r['metric']), None)
+        change = '' if not before else '{:+.1f}%'.format((r['value'] / before - 1) * 100)
+        print('{:>16} {:>36} {:>14} {:>14} {:>14.3f} {:>8}'.format(
+            r['benchmark'], r['case'], r['metric'], '' if before is None else '{:.3f}'.format(before),
+            r['value'], change))
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Run the dataflow benchmarks.')
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='one of {}; all but {} by default'.format(
+                            ', '.join(SUITES), ', '.join(sorted(OPTIONAL))))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of items of every case')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    args = parser.parse_args(argv)
+    for name in args.suites:
+        if name not in SUITES:
+            parser.error('unknown suite: {}'.format(name))
+
+    suites = args.suites or [name for name in SUITES if name not in OPTIONAL]
+
+    results = []
+    for name in suites:
+        start = time.perf_counter()
+        results += SUITES[name].run(args.scale)
+        print('ran {} in {:.1f}s'.format(name, time.perf_counter() - start), file=sys.stderr)
+
+    report = dict(
+        meta=dict(time=time.time(),
+                  revision=git_revision(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  cpu_count=mp.cpu_count(),
+                  scale=args.scale),
+        results=results,
+    )
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
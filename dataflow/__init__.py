@@ -1,3 +1,8 @@
 from .flow import *
 from .pipeline import *
 from .producer import *
+from .transport import *
+from .stream import *
+from .cache import *
+from .profile import *
+from .compression import *
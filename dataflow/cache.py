@@ -0,0 +1,409 @@
+import os
+import sys
+import pickle
+import hashlib
+import threading
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, namedtuple
+from types import CodeType
+from typing import Any, Callable, Hashable, Tuple, Union, List, Optional
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'uncacheable', 'entries', 'nbytes'])
+
+_MISSING = object()
+_UNCACHEABLE = object()
+
+
+# Per-operation memoization cache bounded by entries and, optionally, by the
+# estimated size in bytes of the cached results. Caches are not shared between
+# processes: each producer worker starts with an empty one.
+class MemoCache(metaclass=ABCMeta):
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 0):
+        assert max_entries > 0 and max_bytes >= 0
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._nbytes = 0
+        self._clear_entries()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._reset()
+
+    @abstractmethod
+    def _clear_entries(self):
+        pass
+
+    @abstractmethod
+    def _lookup(self, key: Hashable) -> Any:
+        pass
+
+    @abstractmethod
+    def _contains(self, key: Hashable) -> bool:
+        pass
+
+    @abstractmethod
+    def _insert(self, key: Hashable, val: Any, nbytes: int):
+        pass
+
+    # removes one entry and returns its size
+    @abstractmethod
+    def _evict(self) -> int:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            try:
+                val = self._lookup(key)
+            except TypeError:
+                # not hashable, the call simply is not cached
+                self._uncacheable += 1
+                return _UNCACHEABLE
+
+            if val is _MISSING:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return val
+
+    def put(self, key: Hashable, val: Any):
+        nbytes = _sizeof(val) if self._max_bytes > 0 else 0
+        if self._max_bytes > 0 and nbytes > self._max_bytes:
+            return
+
+        with self._lock:
+            # room for a new key is made before it goes in, an LFU cache would
+            # otherwise evict the key it just took
+            if not self._contains(key):
+                while len(self) > 0 and (len(self) >= self._max_entries or
+                                         (self._max_bytes > 0 and self._nbytes + nbytes > self._max_bytes)):
+                    self._nbytes -= self._evict()
+            self._insert(key, val, nbytes)
+            self._nbytes += nbytes
+            while len(self) > self._max_entries or (self._max_bytes > 0 and self._nbytes > self._max_bytes):
+                self._nbytes -= self._evict()
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._uncacheable, len(self), self._nbytes)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def wrap(self, fn: Callable, consts: Tuple = ()) -> Callable:
+        const_key = consts
+        try:
+            hash(consts)
+        except TypeError:
+            # consts are fixed once a route is compiled, so identity tells them apart
+            const_key = tuple(id(v) for v in consts)
+
+        def memoized(*args):
+            key = (args, const_key)
+            val = self.get(key)
+            if val is _UNCACHEABLE:
+                return fn(*args)
+            if val is _MISSING:
+                val = fn(*args)
+                self.put(key, val)
+            return val
+        return memoized
+
+
+class LRUCache(MemoCache):
+    def _clear_entries(self):
+        self._entries = OrderedDict()
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return _MISSING
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _contains(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _insert(self, key: Hashable, val: Any, nbytes: int):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._nbytes -= old[1]
+        self._entries[key] = (val, nbytes)
+
+    def _evict(self) -> int:
+        _, (_, nbytes) = self._entries.popitem(last=False)
+        return nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class LFUCache(MemoCache):
+    # entries are bucketed by use count, oldest first inside a bucket, so the
+    # least frequently (then least recently) used entry is found in O(1)
+    def _clear_entries(self):
+        self._entries = {}
+        self._buckets = {}
+        self._min_count = 0
+
+    def _touch(self, key: Hashable, count: int) -> int:
+        bucket = self._buckets[count]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+        return count + 1
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return _MISSING
+        val, nbytes, count = entry
+        self._entries[key] = (val, nbytes, self._touch(key, count))
+        return val
+
+    def _contains(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _insert(self, key: Hashable, val: Any, nbytes: int):
+        old = self._entries.get(key, None)
+        if old is not None:
+            self._nbytes -= old[1]
+            self._entries[key] = (val, nbytes, self._touch(key, old[2]))
+            return
+
+        self._entries[key] = (val, nbytes, 1)
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_count = 1
+
+    def _evict(self) -> int:
+        bucket = self._buckets[self._min_count]
+        key, _ = bucket.popitem(last=False)
+        if len(bucket) == 0:
+            del self._buckets[self._min_count]
+            self._min_count = min(self._buckets, default=0)
+        _, nbytes, _ = self._entries.pop(key)
+        return nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _make_memo_cache(memoize: Union[None, str, MemoCache]) -> Union[None, MemoCache]:
+    if memoize is None or isinstance(memoize, MemoCache):
+        return memoize
+    elif memoize == 'lru':
+        return LRUCache()
+    elif memoize == 'lfu':
+        return LFUCache()
+    raise ValueError('un-support memoize: {}'.format(memoize))
+
+
+def _sizeof(val: Any) -> int:
+    if isinstance(val, tuple):
+        return sys.getsizeof(val) + sum(_sizeof(v) for v in val)
+    if type(val).__module__ == 'numpy' and hasattr(val, 'nbytes'):
+        return int(val.nbytes)
+    return sys.getsizeof(val)
+
+
+# Content-addressed cache of operation outputs on local disk. Entries are keyed
+# by a fingerprint of the function (its code, defaults, closure and consts) and
+# of the pickled inputs, so reruns only recompute operations whose code or
+# inputs changed. Changes to other functions an operation calls are not seen.
+# When the directory grows past max_bytes the least recently used entries are
+# removed; several processes may share one directory.
+class DiskCache(object):
+    _SUFFIX = '.pkl'
+
+    def __init__(self, directory: str, max_bytes: int = 1024 ** 3):
+        assert max_bytes > 0
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._nbytes = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key[:2], key + self._SUFFIX)
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                val = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self._misses += 1
+            return False, None
+
+        self._hits += 1
+        return True, val
+
+    def put(self, key: str, val: Any):
+        try:
+            data = pickle.dumps(val, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self._uncacheable += 1
+            return
+        if len(data) > self._max_bytes:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        if self._nbytes is None:
+            self._nbytes = self._scan_size()
+        else:
+            self._nbytes += len(data)
+        if self._nbytes > self._max_bytes:
+            self._evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for sub in os.scandir(self._directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(self._SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # other processes may have written too, so eviction works from the directory itself
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+
+        # evict down to 90% so the next few writes do not trigger another scan
+        target = self._max_bytes * 9 // 10
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+        self._nbytes = total
+
+    def info(self) -> CacheInfo:
+        entries = self._entries()
+        return CacheInfo(self._hits, self._misses, self._uncacheable,
+                         len(entries), sum(size for _, size, _ in entries))
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._nbytes = 0
+
+    def wrap(self, fn: Callable, op_fn: Callable, consts: Tuple = ()) -> Callable:
+        prefix = _fingerprint(op_fn, consts)
+        if prefix is None:
+            return fn
+
+        def cached(*args):
+            try:
+                data = _encode(args)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                self._uncacheable += 1
+                return fn(*args)
+
+            key = hashlib.sha256(prefix + data).hexdigest()
+            found, val = self.get(key)
+            if not found:
+                val = fn(*args)
+                self.put(key, val)
+            return val
+
+        return cached
+
+
+def _fingerprint(fn: Callable, consts: Tuple = ()) -> Optional[bytes]:
+    h = hashlib.sha256()
+    h.update('{}.{}'.format(getattr(fn, '__module__', ''), getattr(fn, '__qualname__', '')).encode())
+
+    code = getattr(fn, '__code__', None)
+    if code is None:
+        return None
+    _hash_code(code, h)
+
+    try:
+        h.update(_encode(getattr(fn, '__defaults__', None)))
+        cells = getattr(fn, '__closure__', None) or ()
+        h.update(_encode(tuple(cell.cell_contents for cell in cells)))
+        h.update(_encode(consts))
+    except (pickle.PicklingError, TypeError, AttributeError, ValueError):
+        return None
+
+    return h.digest()
+
+
+def _hash_code(code: CodeType, h: Any):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _hash_code(const, h)
+        else:
+            h.update(_encode(const))
+
+
+# Pickles a value into key material. Sets iterate in an order that depends on
+# the hash seed of the process, so they are pickled as tuples sorted by the
+# encoding of their elements, which keeps keys stable across processes.
+def _encode(val: Any) -> bytes:
+    return pickle.dumps(_canonical(val), protocol=4)
+
+
+class _SortedSet(tuple):
+    pass
+
+
+def _canonical(val: Any) -> Any:
+    tp = type(val)
+    if tp is set or tp is frozenset:
+        return _SortedSet([tp.__name__] + sorted((_canonical(v) for v in val), key=_encode))
+    if tp is tuple or tp is list:
+        return tp(_canonical(v) for v in val)
+    if tp is dict:
+        return {_canonical(k): _canonical(v) for k, v in val.items()}
+    return val
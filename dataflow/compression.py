@@ -0,0 +1,180 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, IO, Optional, Tuple
+
+
+# compressed file suffix -> (opens a decompressing binary file, compresses one block)
+_CODECS: Dict[str, Tuple[Callable[[str], IO[bytes]], Callable[[bytes], bytes]]] = {
+    '.gz': (lambda filename: gzip.open(filename, 'rb'), lambda data: gzip.compress(data, 6)),
+    '.bz2': (lambda filename: bz2.open(filename, 'rb'), lambda data: bz2.compress(data, 9)),
+    '.xz': (lambda filename: lzma.open(filename, 'rb'), lambda data: lzma.compress(data)),
+}
+
+
+def _compression_of(filename: str) -> Optional[str]:
+    _, ext = os.path.splitext(filename)
+    return ext if ext in _CODECS else None
+
+
+# out.csv.gz -> ('out', '.csv.gz'), so a suffix can go in front of the codec
+def _split_ext(filename: str) -> Tuple[str, str]:
+    root, ext = os.path.splitext(filename)
+    if ext in _CODECS:
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return root, ext
+
+
+# Opens a file like open(), picking a codec from its suffix. Decompression
+# runs ahead in a background thread; compressed output is cut in blocks of
+# `block_size` bytes, each compressed by one of `threads` threads to its own
+# gzip member or bz2/xz stream, and the members are concatenated in order,
+# which every decompressor reads as one file. The codecs release the GIL, so
+# (de)compression overlaps with parsing and formatting. Compressed files can
+# not seek; appending adds members.
+def open_compressed(filename: str,
+                    mode: str = 'r',
+                    buffering: int = -1,
+                    newline: Optional[str] = None,
+                    block_size: int = 1024 * 1024,
+                    threads: int = 0) -> IO[Any]:
+    codec = _compression_of(filename)
+    if codec is None:
+        return open(filename, mode, buffering=buffering, newline=newline)
+
+    assert mode in {'r', 'rb', 'w', 'wb', 'a', 'ab'}
+    buffer_size = buffering if buffering > 0 else io.DEFAULT_BUFFER_SIZE
+    decompressed, compress = _CODECS[codec]
+
+    if mode[0] == 'r':
+        raw = _ThreadedReader(decompressed(filename), block_size)
+        f = io.BufferedReader(raw, buffer_size)
+    else:
+        threads = threads if threads > 0 else min(os.cpu_count() or 1, 4)
+        raw = _BlockWriter(open(filename, mode[0] + 'b'), compress, block_size, threads)
+        f = io.BufferedWriter(raw, buffer_size)
+
+    if mode.endswith('b'):
+        return f
+    return io.TextIOWrapper(f, newline=newline)
+
+
+# Flushes a file from open_compressed and returns its size on disk, where it
+# can be truncated and appended to later.
+def _sync(f: IO[Any]) -> int:
+    f.flush()
+    raw = getattr(getattr(f, 'buffer', f), 'raw', None)
+    if isinstance(raw, _BlockWriter):
+        return raw._sync()
+    return f.tell()
+
+
+class _ThreadedReader(io.RawIOBase):
+    def __init__(self, f: IO[bytes], block_size: int, depth: int = 4):
+        self._f = f
+        self._block_size = block_size
+        self._blocks = queue.Queue(depth)
+        self._block = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                block = self._f.read(self._block_size)
+                self._blocks.put(block)
+                if len(block) == 0:
+                    return
+        except BaseException as e:
+            self._blocks.put(e)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._block) == 0 and not self._eof:
+            block = self._blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            self._eof = len(block) == 0
+            self._block = memoryview(block)
+
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self._stop.set()
+        # unblock a reader thread waiting on a full queue
+        while self._thread.is_alive():
+            try:
+                self._blocks.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self._f.close()
+        super(_ThreadedReader, self).close()
+
+
+class _BlockWriter(io.RawIOBase):
+    def __init__(self, f: IO[bytes], compress: Callable[[bytes], bytes], block_size: int, threads: int):
+        self._f = f
+        self._compress = compress
+        self._block_size = block_size
+        self._threads = threads
+        self._pool = ThreadPoolExecutor(threads)
+        self._pending: deque = deque()
+        self._block = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._block += b
+        if len(self._block) >= self._block_size:
+            self._cut()
+        return len(b)
+
+    def _cut(self):
+        if len(self._block) > 0:
+            self._pending.append(self._pool.submit(self._compress, bytes(self._block)))
+            self._block = bytearray()
+        # a few blocks in flight per thread bound the memory
+        while len(self._pending) > 2 * self._threads:
+            self._write_next()
+        while len(self._pending) > 0 and self._pending[0].done():
+            self._write_next()
+
+    def _write_next(self):
+        future: Future = self._pending.popleft()
+        self._f.write(future.result())
+
+    # ends the current member and writes out every pending one
+    def _sync(self) -> int:
+        self._cut()
+        while len(self._pending) > 0:
+            self._write_next()
+        self._f.flush()
+        return self._f.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._sync()
+        finally:
+            self._pool.shutdown()
+            self._f.close()
+            super(_BlockWriter, self).close()
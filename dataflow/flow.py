@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from typing import Union, Sequence, Callable, Dict, Any
+from typing import Union, Sequence, Callable, Dict, Any, AbstractSet, Tuple, Set, List
 
+from .cache import MemoCache, _make_memo_cache
 from .utils import _trans_str_seq
 
 
@@ -11,13 +12,16 @@ class BaseDataFlow(object):
         self._provides: Dict[str, Factory] = {}
 
         self._fn_op = {}
-        self._const = {}
+        self._const = _Consts()
+        self._index = None
 
     def append_filter(self,
                       fields: Union[str, Sequence[str]],
                       fn: Callable,
-                      g: Union[None, str, Sequence[str]] = None):
-        flt = Filter(self, fields, fn, g)
+                      g: Union[None, str, Sequence[str]] = None,
+                      vectorized: bool = False):
+        self._check_not_frozen()
+        flt = Filter(self, fields, fn, g, vectorized)
 
         for field in flt.fields:
             self._filters[field] = flt
@@ -30,8 +34,11 @@ class BaseDataFlow(object):
                        requires: Union[str, Sequence[str]],
                        provides: Union[str, Sequence[str]],
                        fn: Callable,
-                       g: Union[None, str, Sequence[str]] = None):
-        factory = Factory(self, requires, provides, fn, g)
+                       g: Union[None, str, Sequence[str]] = None,
+                       vectorized: bool = False,
+                       memoize: Union[None, str, MemoCache] = None):
+        self._check_not_frozen()
+        factory = Factory(self, requires, provides, fn, g, vectorized, memoize)
 
         for field in factory.provides:
             self._provides[field] = factory
@@ -53,16 +60,85 @@ class BaseDataFlow(object):
     def const(self) -> Dict[str: Any]:
         return self._const
 
+    # Validates the dependency graph once and indexes it so routes are found
+    # without searching from scratch. Operations cannot be added afterwards,
+    # and a frozen flow must not have cycles even where inputs would break them.
+    def freeze(self) -> BaseDataFlow:
+        if self._index is None:
+            self._index = _FlowIndex(self)
+        return self
+
+    @property
+    def frozen(self) -> bool:
+        return self._index is not None
+
+    @property
+    def index(self) -> _FlowIndex:
+        assert self._index is not None, 'flow is not frozen'
+        return self._index
+
+    def _check_not_frozen(self):
+        if self._index is not None:
+            raise RuntimeError('can not add operations to a frozen flow')
+
+
+# The const values of a flow. Every change bumps `version`, so pipelines know
+# when the consts bound into their compiled routes are stale.
+class _Consts(dict):
+    def __init__(self, *args, **kwargs):
+        super(_Consts, self).__init__(*args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super(_Consts, self).__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super(_Consts, self).__delitem__(key)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        super(_Consts, self).update(*args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        self.version += 1
+        return super(_Consts, self).pop(key, *args)
+
+    def popitem(self):
+        self.version += 1
+        return super(_Consts, self).popitem()
+
+    def clear(self):
+        super(_Consts, self).clear()
+        self.version += 1
+
+    def __reduce__(self):
+        return _Consts, (dict(self),)
+
 
 class Operation(object):
     def __init__(self,
                  flow: BaseDataFlow,
                  fn: Callable,
-                 require_const: Union[None, str, Sequence[str]] = None):
+                 require_const: Union[None, str, Sequence[str]] = None,
+                 vectorized: bool = False,
+                 memoize: Union[None, str, MemoCache] = None):
         assert flow is not None
         assert callable(fn)
         self._flow = flow
         self._fn = fn
+        self._vectorized = vectorized
+        self._memoize = _make_memo_cache(memoize)
 
         if require_const is None:
             self._require_const = []
@@ -78,18 +154,31 @@ class Operation(object):
     def flow(self):
         return self._flow
 
+    @property
+    def fn(self) -> Callable:
+        return self._fn
+
     @property
     def require_const(self):
         return self._require_const
 
+    @property
+    def vectorized(self) -> bool:
+        return self._vectorized
+
+    @property
+    def memoize(self) -> Union[None, MemoCache]:
+        return self._memoize
+
 
 class Filter(Operation):
     def __init__(self,
                  flow: BaseDataFlow,
                  fields: Union[str, Sequence[str]],
                  fn: Callable,
-                 require_const: Union[None, str, Sequence[str]] = None):
-        super(Filter, self).__init__(flow, fn, require_const)
+                 require_const: Union[None, str, Sequence[str]] = None,
+                 vectorized: bool = False):
+        super(Filter, self).__init__(flow, fn, require_const, vectorized)
 
         assert fields is not None
         fields = _trans_str_seq(fields)
@@ -107,8 +196,10 @@ class Factory(Operation):
                  requires: Union[str, Sequence[str]],
                  provides: Union[str, Sequence[str]],
                  fn: Callable,
-                 require_const: Union[None, str, Sequence[str]] = None):
-        super(Factory, self).__init__(flow, fn, require_const)
+                 require_const: Union[None, str, Sequence[str]] = None,
+                 vectorized: bool = False,
+                 memoize: Union[None, str, MemoCache] = None):
+        super(Factory, self).__init__(flow, fn, require_const, vectorized, memoize)
 
         assert requires is not None
         assert provides is not None
@@ -134,17 +225,149 @@ class DataFlow(BaseDataFlow):
         super(DataFlow, self).__init__()
 
     def filter(self, fields: Union[str, Sequence[str]],
-               require_const: Union[None, str, Sequence[str]] = None) -> Callable:
+               require_const: Union[None, str, Sequence[str]] = None,
+               vectorized: bool = False) -> Callable:
         def wrap(fn):
-            self.append_filter(fields, fn, require_const)
+            self.append_filter(fields, fn, require_const, vectorized)
             return fn
         return wrap
 
     def factory(self,
                 requires: Union[str, Sequence[str]],
                 provides: Union[str, Sequence[str]],
-                require_const: Union[None, str, Sequence[str]] = None) -> Callable:
+                require_const: Union[None, str, Sequence[str]] = None,
+                vectorized: bool = False,
+                memoize: Union[None, str, MemoCache] = None) -> Callable:
         def wrap(fn):
-            self.append_factory(requires, provides, fn, require_const)
+            self.append_factory(requires, provides, fn, require_const, vectorized, memoize)
             return fn
         return wrap
+
+
+# Dependency index of a frozen flow: factories in topological order and, for
+# every field, the factories and fields it transitively depends on.
+class _FlowIndex(object):
+    def __init__(self, flow: BaseDataFlow):
+        # noinspection PyProtectedMember
+        provides, filters = dict(flow._provides), flow._filters
+        self._provides = provides
+
+        order = {}
+        closure = {}
+        upstream = {}
+
+        def requires_of(f):
+            factory = provides.get(f, None)
+            return () if factory is None else factory.requires
+
+        for root in provides:
+            if root in closure:
+                continue
+
+            stack = [(root, iter(requires_of(root)))]
+            visiting = {root}
+            while len(stack) > 0:
+                field, it = stack[-1]
+                for r in it:
+                    if r in visiting:
+                        raise CircularDependence(r)
+                    if r not in closure:
+                        visiting.add(r)
+                        stack.append((r, iter(requires_of(r))))
+                        break
+                else:
+                    stack.pop()
+                    visiting.discard(field)
+
+                    factory = provides.get(field, None)
+                    if factory is None:
+                        closure[field], upstream[field] = frozenset(), frozenset()
+                        continue
+
+                    ops, fields = {factory}, set(factory.requires)
+                    for r in factory.requires:
+                        ops.update(closure[r])
+                        fields.update(upstream[r])
+                    closure[field], upstream[field] = frozenset(ops), frozenset(fields)
+                    order.setdefault(factory, len(order))
+
+        self._order = order
+        self._closure = closure
+        self._upstream = upstream
+
+        self._filters = dict(filters)
+        self._filter_order = {}
+        for flt in filters.values():
+            self._filter_order.setdefault(flt, len(self._filter_order))
+
+    def closure(self, field: str) -> AbstractSet[Factory]:
+        return self._closure.get(field, frozenset())
+
+    def upstream(self, field: str) -> AbstractSet[str]:
+        return self._upstream.get(field, frozenset())
+
+    def search_route(self,
+                     targets: AbstractSet[str],
+                     inputs: AbstractSet[str]) -> Tuple[Set[str], List[Operation]]:
+        init, ops = self._search_factories(targets, inputs)
+
+        filters = {self._filters[field] for field in init if field in self._filters}
+        filters = sorted(filters, key=self._filter_order.__getitem__)
+        for flt in filters:
+            init.update(flt.fields)
+
+        for field in init:
+            if field not in inputs:
+                raise TypeError('missing inputs: {}'.format(field))
+
+        return init, filters + sorted(ops, key=self._order.__getitem__)
+
+    def _search_factories(self,
+                          targets: AbstractSet[str],
+                          inputs: AbstractSet[str]) -> Tuple[Set[str], Set[Factory]]:
+        provides = self._provides
+
+        # when no input is itself a product of the route, the closures are the route
+        derived = [t for t in targets if t not in inputs]
+        fields = set(derived)
+        for t in derived:
+            fields.update(self.upstream(t))
+        if all(f not in inputs for f in fields if f in provides):
+            ops = set()
+            for t in derived:
+                if t not in provides:
+                    raise TypeError('No factory can produce {}.'.format(t))
+                ops.update(self._closure[t])
+            init = {t for t in targets if t in inputs}
+            for f in fields:
+                if f not in provides:
+                    if f not in inputs:
+                        raise TypeError('No factory can produce {}.'.format(f))
+                    init.add(f)
+            return init, ops
+
+        init, ops = set(), set()
+        requires, visited = list(targets), set()
+        while len(requires) > 0:
+            field = requires.pop()
+            if field in visited:
+                continue
+            visited.add(field)
+
+            if field in inputs:
+                init.add(field)
+                continue
+
+            factory = provides.get(field, None)
+            if factory is None:
+                raise TypeError('No factory can produce {}.'.format(field))
+            if factory not in ops:
+                ops.add(factory)
+                requires += factory.requires
+
+        return init, ops
+
+
+class CircularDependence(ValueError):
+    def __init__(self, field: str):
+        super(CircularDependence, self).__init__('{} field circular dependence.'.format(field))
@@ -1,15 +1,34 @@
+import os
+import time
 import typing
+import asyncio
+import inspect
+import functools
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Executor, Future, wait, FIRST_COMPLETED
 
 from abc import ABCMeta, abstractmethod
-from typing import Union, Mapping, Any, Sequence, List, Tuple, AbstractSet, Set, Optional, Dict
+from collections.abc import Mapping as MappingABC
+from typing import Union, Mapping, Any, Sequence, List, Tuple, AbstractSet, Set, Optional, Dict, Callable
 
-from .flow import BaseDataFlow, Filter, Factory, Operation
+from .flow import BaseDataFlow, Filter, Factory, Operation, CircularDependence
+from .cache import DiskCache
+from .profile import Profiler
 from .utils import _trans_str_seq
 
 
+PreHook = Callable[[Operation], None]
+PostHook = Callable[[Operation, float, Optional[BaseException]], None]
+_HookPair = Tuple[Optional[PreHook], Optional[PostHook]]
+
+
 class Pipeline(metaclass=ABCMeta):
     def __init__(self, flow: BaseDataFlow):
         self._flow = flow
+        self._hooks: List[_HookPair] = []
+        self._profiler = None
 
     @abstractmethod
     def exec(self,
@@ -22,16 +41,55 @@ class Pipeline(metaclass=ABCMeta):
     def product(self, target: Union[str, Sequence[str]], inputs: Mapping[str, Any]) -> Any:
         pass
 
+    def product_batch(self,
+                      target: Union[str, Sequence[str]],
+                      items: Sequence[Mapping[str, Any]]) -> List[Any]:
+        return [self.product(target, inputs) for inputs in items]
+
     @property
     def flow(self):
         return self._flow
 
+    # pre(op) runs before every operation call, post(op, elapsed, exc) after
+    # it, with exc set when the call raised
+    def add_hook(self, pre: Optional[PreHook] = None, post: Optional[PostHook] = None):
+        assert pre is not None or post is not None
+        self._hooks.append((pre, post))
+
+    def clear_hooks(self):
+        self._hooks = []
+        self._profiler = None
+
+    def enable_profiling(self) -> Profiler:
+        if self._profiler is None:
+            self._profiler = Profiler()
+            self.add_hook(post=self._profiler.post)
+        return self._profiler
+
+    @property
+    def profiler(self) -> Optional[Profiler]:
+        return self._profiler
+
 
 class SerialPipeline(Pipeline):
-    def __init__(self, flow: BaseDataFlow):
+    # compiled routes kept, least recently used ones are dropped first
+    _ROUTE_CACHE_SIZE = 1024
+
+    def __init__(self, flow: BaseDataFlow, disk_cache: Optional[DiskCache] = None):
         super(SerialPipeline, self).__init__(flow)
 
-        self._cache_for_route = {}
+        self._cache_for_route = OrderedDict()
+        self._const_version = flow.const.version
+        self._disk_cache = disk_cache
+
+    # routes compiled before carry the old hooks
+    def add_hook(self, pre: Optional[PreHook] = None, post: Optional[PostHook] = None):
+        super(SerialPipeline, self).add_hook(pre, post)
+        self._cache_for_route.clear()
+
+    def clear_hooks(self):
+        super(SerialPipeline, self).clear_hooks()
+        self._cache_for_route.clear()
 
     def exec(self, fn, inputs: Mapping[str, Any], return_dict: bool = False) -> Any:
         op = self.flow.operation(fn)
@@ -61,22 +119,35 @@ class SerialPipeline(Pipeline):
         targets = _trans_str_seq(target)
         assert len(target) > 0
 
-        _, route = self._get_route(set(targets), inputs.keys())
-        vals = self._exec_chain(inputs, route)
+        plan = self._get_plan(set(targets), inputs.keys())
+        vals = self._run_plan(plan, inputs)
 
         if isinstance(target, str):
-            return vals[target]
+            return vals[plan.slot_of[target]]
         else:
-            return tuple(vals[t] for t in targets)
+            slot_of = plan.slot_of
+            return tuple(vals[slot_of[t]] for t in targets)
+
+    def product_lazy(self, target: Union[str, Sequence[str]], inputs: Mapping[str, Any]) -> 'LazyResult':
+        assert target is not None and inputs is not None
+        targets = _trans_str_seq(target)
+        assert len(target) > 0
+
+        return LazyResult(self, targets, inputs)
 
     # noinspection PyMethodMayBeStatic
+    def _run_plan(self, plan: '_RoutePlan', inputs: Mapping[str, Any]) -> List[Any]:
+        return plan(inputs)
+
+    # noinspection PyMethodMayBeStatic
+    # Runs a route operation by operation on a dict of values. Not used to
+    # produce: it is the reference the compiled plans are tested and
+    # benchmarked against.
     def _exec_chain(self,
                     inputs: Mapping[str, Any],
                     route: Sequence[Operation]) -> Dict[str, Any]:
         vals = dict(inputs)
 
-        # print(vals)
-
         for op in route:
             op = typing.cast(Union[Filter, Factory, Operation], op)
             if isinstance(op, Filter):
@@ -94,43 +165,72 @@ class SerialPipeline(Pipeline):
             else:
                 raise TypeError('unknown operation.'
                                 'The current version only supports Filter and Factory')
-            # print(vals)
 
         return vals
 
     def _get_route(self,
                    targets: AbstractSet[str],
                    inputs: AbstractSet[str]) -> Tuple[Set[str], List[Operation]]:
-        init_and_route = self._get_cached_route(targets, inputs)
+        plan = self._get_plan(targets, inputs)
+        return plan.init, plan.route
 
-        if init_and_route is not None:
-            return init_and_route
+    def _get_plan(self,
+                  targets: AbstractSet[str],
+                  inputs: AbstractSet[str]) -> '_RoutePlan':
+        plan = self._get_cached_route(targets, inputs)
 
-        init_and_route = self._search_route(targets, inputs)
-        self._cache_route((targets, inputs), init_and_route)
+        if plan is not None:
+            return plan
 
-        return init_and_route
+        init, route = self._search_route(targets, inputs)
+        plan = self._compile_route(targets, init, route)
+        self._cache_route((inputs, targets), plan)
+
+        return plan
+
+    def _compile_route(self,
+                       targets: AbstractSet[str],
+                       init: AbstractSet[str],
+                       route: Sequence[Operation]) -> '_RoutePlan':
+        return _RoutePlan(self.flow, targets, init, route, self._disk_cache, self._hooks)
 
     def _get_cached_route(self,
                           targets: AbstractSet[str],
-                          inputs: AbstractSet[str]) -> Optional[Tuple[Set[str], List[Operation]]]:
-        inputs = tuple(sorted(inputs))
-        targets = tuple(sorted(targets))
+                          inputs: AbstractSet[str]) -> Optional['_RoutePlan']:
+        # routes compiled before have the old consts bound
+        version = self.flow.const.version
+        if version != self._const_version:
+            self._cache_for_route.clear()
+            self._const_version = version
+
+        key = (frozenset(inputs), frozenset(targets))
+        plan = self._cache_for_route.get(key, None)
+
+        if plan is not None:
+            try:
+                self._cache_for_route.move_to_end(key)
+            except KeyError:
+                # evicted by another thread meanwhile
+                pass
 
-        return self._cache_for_route.get((inputs, targets), None)
+        return plan
 
     def _cache_route(self,
                      inputs_and_targets: Tuple[AbstractSet[str], AbstractSet[str]],
-                     init_and_route: Tuple[Set[str], Sequence[Operation]]):
+                     plan: '_RoutePlan'):
         inputs, targets = inputs_and_targets
-        inputs = tuple(sorted(inputs))
-        targets = tuple(sorted(targets))
+        cache = self._cache_for_route
 
-        self._cache_for_route[(inputs, targets)] = init_and_route
+        cache[(frozenset(inputs), frozenset(targets))] = plan
+        while len(cache) > self._ROUTE_CACHE_SIZE:
+            cache.popitem(last=False)
 
     def _search_route(self,
                       targets: AbstractSet[str],
                       inputs: AbstractSet[str]) -> Tuple[Set[str], List[Factory]]:
+        if self.flow.frozen:
+            return self.flow.index.search_route(targets, inputs)
+
         init, factory_route = self._search_factory_route(targets, inputs)
         init, filter_route = self._search_filter_route(inputs, init)
 
@@ -139,14 +239,15 @@ class SerialPipeline(Pipeline):
     def _search_filter_route(self,
                              inputs: AbstractSet[str],
                              init: AbstractSet[str]) -> Tuple[Set[str], List[Filter]]:
-        route = set()
+        # a dict keeps the filters unique and in a deterministic order
+        route = {}
         requires = set(init)
         flow = self.flow
 
-        for field in init:
+        for field in sorted(init):
             try:
                 fltr = flow.get_filter(field)
-                route.add(fltr)
+                route[fltr] = None
                 requires = requires.union(flow.get_filter(field).fields)
             except KeyError:
                 pass
@@ -204,6 +305,512 @@ class SerialPipeline(Pipeline):
         return init, route
 
 
-class CircularDependence(ValueError):
-    def __init__(self, field: str):
-        super(CircularDependence, self).__init__('{} field circular dependence.'.format(field))
+# Read-only mapping of targets to values. A field is computed the first time
+# it is read, running only the operations it needs that have not run yet.
+class LazyResult(MappingABC):
+    def __init__(self, pipe: SerialPipeline, targets: Sequence[str], inputs: Mapping[str, Any]):
+        self._pipe = pipe
+        self._targets = tuple(targets)
+        self._inputs = inputs
+        self._vals = dict(inputs)
+        self._done = set()
+        self._computed = set()
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._targets:
+            raise KeyError(key)
+
+        if key not in self._computed:
+            self._compute(key)
+            self._computed.add(key)
+
+        return self._vals[key]
+
+    # Mapping would look the value up, running its route
+    def __contains__(self, key: object) -> bool:
+        return key in self._targets
+
+    def _compute(self, key: str):
+        # noinspection PyProtectedMember
+        plan = self._pipe._get_plan({key}, self._inputs.keys())
+        vals = self._vals
+
+        # noinspection PyProtectedMember
+        for op, (fn, _, _), (requires, provides) in zip(plan.route, plan._steps, plan._fields):
+            if op in self._done:
+                continue
+
+            result = fn(*[vals[field] for field in requires])
+            result = (result,) if len(provides) == 1 else result
+            for field, v in zip(provides, result):
+                if field is not None:
+                    vals[field] = v
+            self._done.add(op)
+
+    def is_computed(self, key: str) -> bool:
+        return key in self._computed
+
+    def __iter__(self):
+        return iter(self._targets)
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+
+class BatchPipeline(SerialPipeline):
+    def product(self, target: Union[str, Sequence[str]], inputs: Mapping[str, Any]) -> Any:
+        return self.product_batch(target, [inputs])[0]
+
+    def product_batch(self,
+                      target: Union[str, Sequence[str]],
+                      items: Sequence[Mapping[str, Any]]) -> List[Any]:
+        assert target is not None and items is not None
+        targets = _trans_str_seq(target)
+        assert len(target) > 0
+
+        if len(items) == 0:
+            return []
+
+        plan = self._get_plan(set(targets), items[0].keys())
+        plan = typing.cast(_BatchRoutePlan, plan)
+        cols = plan.run_batch(items)
+
+        if isinstance(target, str):
+            return list(cols[plan.slot_of[target]])
+        else:
+            slot_of = plan.slot_of
+            return list(zip(*[cols[slot_of[t]] for t in targets]))
+
+    def _compile_route(self,
+                       targets: AbstractSet[str],
+                       init: AbstractSet[str],
+                       route: Sequence[Operation]) -> '_RoutePlan':
+        return _BatchRoutePlan(self.flow, targets, init, route, self._disk_cache, self._hooks)
+
+
+class ThreadedDagPipeline(SerialPipeline):
+    def __init__(self, flow: BaseDataFlow, max_workers: int = 0, disk_cache: Optional[DiskCache] = None):
+        super(ThreadedDagPipeline, self).__init__(flow, disk_cache)
+
+        self._max_workers = max_workers
+
+    def _run_plan(self, plan: '_RoutePlan', inputs: Mapping[str, Any]) -> List[Any]:
+        plan = typing.cast(_DagRoutePlan, plan)
+        return plan.run_threaded(inputs, _shared_executor(self._max_workers))
+
+    def _compile_route(self,
+                       targets: AbstractSet[str],
+                       init: AbstractSet[str],
+                       route: Sequence[Operation]) -> '_RoutePlan':
+        return _DagRoutePlan(self.flow, targets, init, route, self._disk_cache, self._hooks)
+
+
+class AsyncPipeline(SerialPipeline):
+    def product(self, target: Union[str, Sequence[str]], inputs: Mapping[str, Any]) -> Any:
+        return asyncio.run(self.aproduct(target, inputs))
+
+    async def aproduct(self, target: Union[str, Sequence[str]], inputs: Mapping[str, Any]) -> Any:
+        assert target is not None and inputs is not None
+        targets = _trans_str_seq(target)
+        assert len(target) > 0
+
+        plan = self._get_plan(set(targets), inputs.keys())
+        plan = typing.cast(_DagRoutePlan, plan)
+        vals = await plan.run_async(inputs)
+
+        if isinstance(target, str):
+            return vals[plan.slot_of[target]]
+        else:
+            slot_of = plan.slot_of
+            return tuple(vals[slot_of[t]] for t in targets)
+
+    def _compile_route(self,
+                       targets: AbstractSet[str],
+                       init: AbstractSet[str],
+                       route: Sequence[Operation]) -> '_RoutePlan':
+        return _DagRoutePlan(self.flow, targets, init, route, self._disk_cache, self._hooks)
+
+
+_executors_lock = threading.Lock()
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_executors_pid = None
+
+
+def _shared_executor(max_workers: int = 0) -> Executor:
+    global _executors_pid
+
+    with _executors_lock:
+        # threads do not survive a fork, so pools inherited from the parent are dropped
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+
+        executor = _executors.get(max_workers, None)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers if max_workers > 0 else None,
+                                          thread_name_prefix='dataflow')
+            _executors[max_workers] = executor
+
+        return executor
+
+
+# A route compiled for repeated execution: every field gets an integer slot and
+# argument slots, output slots and const kwargs are resolved once per route.
+class _RoutePlan(object):
+    def __init__(self,
+                 flow: BaseDataFlow,
+                 targets: AbstractSet[str],
+                 init: AbstractSet[str],
+                 route: Sequence[Operation],
+                 disk_cache: Optional[DiskCache] = None,
+                 hooks: Sequence[_HookPair] = ()):
+        self.init = set(init)
+        self.route = list(route)
+        self._disk_cache = disk_cache
+        self._hooks = tuple(hooks)
+
+        slot_of = {}
+        for field in sorted(init):
+            slot_of[field] = len(slot_of)
+
+        num_slots = len(slot_of)
+        steps, fields = [], []
+        for op in route:
+            op = typing.cast(Union[Filter, Factory, Operation], op)
+            if isinstance(op, Filter):
+                requires, provides = op.fields, op.fields
+            elif isinstance(op, Factory):
+                # a factory never overwrites an input, the extra outputs go to
+                # slots nothing reads
+                requires = op.requires
+                provides = [None if field in self.init else field for field in op.provides]
+            else:
+                raise TypeError('unknown operation.'
+                                'The current version only supports Filter and Factory')
+
+            outs = []
+            for field in provides:
+                if field is None:
+                    outs.append(num_slots)
+                    num_slots += 1
+                    continue
+                if field not in slot_of:
+                    slot_of[field] = num_slots
+                    num_slots += 1
+                outs.append(slot_of[field])
+
+            steps.append((self._bind(flow, op),
+                          tuple(slot_of[field] for field in requires),
+                          tuple(outs)))
+            fields.append((tuple(requires), tuple(provides)))
+
+        for field in targets:
+            if field not in slot_of:
+                raise TypeError('missing inputs: {}'.format(field))
+
+        # a slot that is not a target is dropped right after the last step
+        # touching it, so large intermediates do not live until the route ends
+        self._keep = frozenset(slot_of[field] for field in targets)
+        last_use = {}
+        for i, (_, args, outs) in enumerate(steps):
+            for slot in args + outs:
+                last_use[slot] = i
+        frees = [[] for _ in steps]
+        for slot, i in sorted(last_use.items()):
+            if slot not in self._keep:
+                frees[i].append(slot)
+
+        self.slot_of = slot_of
+        self._inputs = tuple((field, slot_of[field]) for field in sorted(init))
+        self._num_slots = num_slots
+        self._steps = tuple(steps)
+        self._fields = tuple(fields)
+        self._frees = tuple(tuple(slots) for slots in frees)
+
+    # whether vectorized operations are called with one row at a time
+    _scalar = True
+
+    def _bind(self, flow: BaseDataFlow, op: Operation) -> typing.Callable:
+        const = {k: flow.const[k] for k in op.require_const}
+        fn = op.fn if len(const) == 0 else functools.partial(op.fn, **const)
+        if op.vectorized and self._scalar:
+            num_outs = len(op.fields) if isinstance(op, Filter) else len(op.provides)
+            fn = _as_scalar(fn, num_outs, inspect.iscoroutinefunction(op.fn))
+
+        # awaiting a cached coroutine twice would fail, so async operations are not cached
+        if inspect.iscoroutinefunction(op.fn):
+            return fn if len(self._hooks) == 0 else _with_async_hooks(fn, op, self._hooks)
+
+        if self._disk_cache is not None:
+            fn = self._disk_cache.wrap(fn, op.fn, tuple(const.values()))
+        if op.memoize is not None:
+            fn = op.memoize.wrap(fn, tuple(const.values()))
+
+        return fn if len(self._hooks) == 0 else _with_hooks(fn, op, self._hooks)
+
+    def __call__(self, inputs: Mapping[str, Any]) -> List[Any]:
+        vals = [None] * self._num_slots
+
+        for field, slot in self._inputs:
+            vals[slot] = inputs[field]
+
+        for (fn, args, outs), frees in zip(self._steps, self._frees):
+            result = fn(*[vals[i] for i in args])
+            if len(outs) == 1:
+                vals[outs[0]] = result
+            else:
+                for i, v in zip(outs, result):
+                    vals[i] = v
+            for i in frees:
+                vals[i] = None
+
+        return vals
+
+
+# Runs a plan over a batch of items stored column-wise: vectorized operations
+# are called once per batch, others fall back to a per-row loop.
+class _BatchRoutePlan(_RoutePlan):
+    _scalar = False
+
+    def __init__(self,
+                 flow: BaseDataFlow,
+                 targets: AbstractSet[str],
+                 init: AbstractSet[str],
+                 route: Sequence[Operation],
+                 disk_cache: Optional[DiskCache] = None,
+                 hooks: Sequence[_HookPair] = ()):
+        super(_BatchRoutePlan, self).__init__(flow, targets, init, route, disk_cache, hooks)
+
+        self._vectorized = tuple(op.vectorized for op in self.route)
+
+    def run_batch(self, items: Sequence[Mapping[str, Any]]) -> List[Any]:
+        cols = [None] * self._num_slots
+
+        for field, slot in self._inputs:
+            cols[slot] = [inputs[field] for inputs in items]
+
+        for (fn, args, outs), frees, vectorized in zip(self._steps, self._frees, self._vectorized):
+            if vectorized:
+                for i in args:
+                    cols[i] = _as_column(cols[i])
+                result = fn(*[cols[i] for i in args])
+                result = (result,) if len(outs) == 1 else result
+            else:
+                rows = [fn(*row) for row in zip(*[cols[i] for i in args])]
+                result = (rows,) if len(outs) == 1 else [list(col) for col in zip(*rows)]
+
+            for i, col in zip(outs, result):
+                cols[i] = col
+            for i in frees:
+                cols[i] = None
+
+        return cols
+
+
+# Keeps the dependency DAG of a route so independent operations can run
+# concurrently. Dependencies follow the slots each operation reads and writes.
+class _DagRoutePlan(_RoutePlan):
+    def __init__(self,
+                 flow: BaseDataFlow,
+                 targets: AbstractSet[str],
+                 init: AbstractSet[str],
+                 route: Sequence[Operation],
+                 disk_cache: Optional[DiskCache] = None,
+                 hooks: Sequence[_HookPair] = ()):
+        super(_DagRoutePlan, self).__init__(flow, targets, init, route, disk_cache, hooks)
+
+        last_writer = {}
+        readers = {}
+        deps = []
+
+        for i, (_, args, outs) in enumerate(self._steps):
+            dep = {last_writer[slot] for slot in args + outs if slot in last_writer}
+            for slot in outs:
+                dep.update(readers.get(slot, ()))
+            dep.discard(i)
+            deps.append(tuple(sorted(dep)))
+
+            for slot in args:
+                readers.setdefault(slot, set()).add(i)
+            for slot in outs:
+                last_writer[slot] = i
+                readers[slot] = set()
+
+        dependents = [[] for _ in deps]
+        for i, dep in enumerate(deps):
+            for j in dep:
+                dependents[j].append(i)
+
+        levels = []
+        for dep in deps:
+            levels.append(1 + max((levels[j] for j in dep), default=-1))
+
+        # steps may finish in any order, so slots are dropped by counting the
+        # steps touching them instead of by route position
+        touches = [tuple(sorted(set(args + outs))) for _, args, outs in self._steps]
+        uses = [0] * self._num_slots
+        for slots in touches:
+            for slot in slots:
+                uses[slot] += 1
+
+        self.deps = tuple(deps)
+        self.levels = tuple(levels)
+        self._dependents = tuple(tuple(d) for d in dependents)
+        self._touches = tuple(touches)
+        self._uses = tuple(uses)
+
+    def _release(self, vals: List[Any], remaining: List[int], i: int):
+        for slot in self._touches[i]:
+            remaining[slot] -= 1
+            if remaining[slot] == 0 and slot not in self._keep:
+                vals[slot] = None
+
+    def _run_step(self, vals: List[Any], i: int):
+        fn, args, outs = self._steps[i]
+        result = fn(*[vals[j] for j in args])
+        if len(outs) == 1:
+            vals[outs[0]] = result
+        else:
+            for j, v in zip(outs, result):
+                vals[j] = v
+
+    def run_threaded(self, inputs: Mapping[str, Any], executor: Executor) -> List[Any]:
+        vals = [None] * self._num_slots
+
+        for field, slot in self._inputs:
+            vals[slot] = inputs[field]
+
+        remaining = list(self._uses)
+        waiting = [len(dep) for dep in self.deps]
+        ready = [i for i, n in enumerate(waiting) if n == 0]
+        pending: Dict[Future, int] = {}
+
+        while len(ready) > 0 or len(pending) > 0:
+            # nothing else can run meanwhile, so skip the hop through the pool
+            if len(ready) == 1 and len(pending) == 0:
+                finished = [ready.pop()]
+                self._run_step(vals, finished[0])
+            else:
+                for i in ready:
+                    pending[executor.submit(self._run_step, vals, i)] = i
+                ready = []
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finished = []
+                for future in done:
+                    finished.append(pending.pop(future))
+                    future.result()
+
+            for i in finished:
+                self._release(vals, remaining, i)
+                for j in self._dependents[i]:
+                    waiting[j] -= 1
+                    if waiting[j] == 0:
+                        ready.append(j)
+
+        return vals
+
+    async def run_async(self, inputs: Mapping[str, Any]) -> List[Any]:
+        vals = [None] * self._num_slots
+
+        for field, slot in self._inputs:
+            vals[slot] = inputs[field]
+
+        remaining = list(self._uses)
+        tasks = []
+
+        async def run_step(i: int):
+            if len(self.deps[i]) > 0:
+                await asyncio.gather(*[tasks[j] for j in self.deps[i]])
+
+            fn, args, outs = self._steps[i]
+            result = fn(*[vals[j] for j in args])
+            if inspect.isawaitable(result):
+                result = await result
+
+            if len(outs) == 1:
+                vals[outs[0]] = result
+            else:
+                for j, v in zip(outs, result):
+                    vals[j] = v
+            self._release(vals, remaining, i)
+
+        for i in range(len(self._steps)):
+            tasks.append(asyncio.ensure_future(run_step(i)))
+
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        return vals
+
+
+def _with_hooks(fn: Callable, op: Operation, hooks: Sequence[_HookPair]) -> Callable:
+    def hooked(*args):
+        for pre, _ in hooks:
+            if pre is not None:
+                pre(op)
+
+        exc = None
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            for _, post in hooks:
+                if post is not None:
+                    post(op, elapsed, exc)
+    return hooked
+
+
+def _with_async_hooks(fn: Callable, op: Operation, hooks: Sequence[_HookPair]) -> Callable:
+    async def hooked(*args):
+        for pre, _ in hooks:
+            if pre is not None:
+                pre(op)
+
+        exc = None
+        start = time.perf_counter()
+        try:
+            return await fn(*args)
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            for _, post in hooks:
+                if post is not None:
+                    post(op, elapsed, exc)
+    return hooked
+
+
+# Calls a vectorized operation with one-row columns and returns the row of its
+# output columns.
+def _as_scalar(fn: Callable, num_outs: int, is_async: bool) -> Callable:
+    def unwrap(result):
+        return result[0] if num_outs == 1 else tuple(col[0] for col in result)
+
+    if is_async:
+        async def scalar_async(*args):
+            return unwrap(await fn(*[_as_column([v]) for v in args]))
+        return scalar_async
+
+    def scalar(*args):
+        return unwrap(fn(*[_as_column([v]) for v in args]))
+    return scalar
+
+
+def _as_column(values: Any) -> Any:
+    try:
+        # noinspection PyPackageRequirements
+        import numpy as np
+    except ImportError:
+        return values
+
+    return np.asarray(values)
@@ -1,12 +1,22 @@
+import os
+import json
+import time
 import heapq
+import typing
+import queue
+import asyncio
+import threading
 import multiprocessing as mp
 
 from abc import ABCMeta, abstractmethod
-from typing import Optional, Callable, Sequence
+from typing import Optional, Callable, Sequence, List, Dict, Any, Iterable, Iterator, Tuple, Union
 
-from .stream import InStream, OutStream
-from .pipeline import Pipeline, SerialPipeline
+from .stream import InStream, OutStream, Splittable, InShard, Resumable, Shardable, fan_out
+from .pipeline import Pipeline, SerialPipeline, AsyncPipeline
 from .flow import BaseDataFlow
+from .transport import Transport, _is_ndarray
+from .utils import _trans_str_seq
+from .profile import Profiler
 
 
 class Producer(metaclass=ABCMeta):
@@ -16,98 +26,1092 @@ class Producer(metaclass=ABCMeta):
 
 
 class ParallelProducer(Producer):
+    # bounds of the adaptive chunk size used when chunk_size is 0
+    _MAX_CHUNK_SIZE = 1024
+    _FALLBACK_CHUNK_SIZE = 64
+    # seconds between two autoscaling decisions
+    _SCALE_INTERVAL = 0.5
+
     def __init__(self,
                  num_workers: int = 0,
-                 pipe_cls: Optional[Callable[[BaseDataFlow], Pipeline]] = None):
-        self._num_workers = num_workers if num_workers > 0 else mp.cpu_count()
+                 pipe_cls: Optional[Callable[[BaseDataFlow], Pipeline]] = None,
+                 chunk_size: int = 0,
+                 max_queue_size: int = 0,
+                 reorder_window: int = 0,
+                 transport: Optional[Transport] = None,
+                 split_input: bool = False,
+                 profile: bool = False,
+                 min_workers: int = 0,
+                 max_workers: int = 0,
+                 persistent: bool = False,
+                 num_writers: int = 1,
+                 merge_parts: bool = False):
+        assert chunk_size >= 0 and max_queue_size >= 0 and reorder_window >= 0 and num_writers >= 1
+        assert 0 <= min_workers and (max_workers == 0 or min_workers <= max_workers)
+        assert not persistent or not (split_input or profile or max_workers > 0), \
+            'persistent workers can not split the input, profile or autoscale'
+        # a max_workers enables autoscaling between min_workers and max_workers,
+        # starting from num_workers
+        self._max_workers = max_workers
+        self._min_workers = max(min_workers, 1) if max_workers > 0 else 0
+        if max_workers > 0:
+            self._num_workers = min(max(num_workers, self._min_workers), max_workers)
+        else:
+            self._num_workers = num_workers if num_workers > 0 else mp.cpu_count()
         self._pipe_cls = pipe_cls if pipe_cls is not None else SerialPipeline
+        self._chunk_size = chunk_size
+        # queue depth in chunks, 0 means a few chunks per worker
+        self._max_queue_size = max_queue_size if max_queue_size > 0 else 4 * max(self._num_workers, max_workers)
+        # how many items the reader may run ahead of the writer, 0 means unlimited
+        self._reorder_window = reorder_window
+        self._transport = transport if transport is not None else Transport()
+        # let every worker read its own shards of a Splittable input
+        self._split_input = split_input
+        # profile the operations in every worker, merged into one report
+        self._profile = profile
+        self._profiler = None
+        # keep the produce workers and their pipelines alive between runs of
+        # the same frozen flow, the reader and writer then run as threads of
+        # the caller
+        self._persistent = persistent
+        self._pool = None
+        # unordered runs to a Shardable stream write num_writers part files,
+        # joined into the stream's own output at the end with merge_parts
+        self._num_writers = num_writers
+        self._merge_parts = merge_parts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # stops the persistent workers, a later run starts new ones
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
     def produce(self,
                 flow: BaseDataFlow,
                 ins: InStream,
-                ous: OutStream,
+                ous: Union[OutStream, Sequence[OutStream]],
                 keep_order: bool = False,
-                pbar: str = 'none'):
+                pbar: str = 'none',
+                checkpoint: Optional[str] = None,
+                checkpoint_interval: float = 60.0,
+                resume: bool = False,
+                metrics: Union[None, str, Callable[[Dict[str, Any]], None]] = None,
+                metrics_interval: float = 1.0):
         pbar = pbar.lower()
         assert pbar in {'none', 'terminal', 'notebook'}
+        # several sinks share one route computing all of their columns
+        ous = fan_out(ous)
 
-        inq, ouq = mp.Queue(), mp.Queue()
+        done = _DoneIndices()
+        if checkpoint is not None:
+            if not isinstance(ous, Resumable):
+                raise TypeError('checkpoint needs a Resumable OutStream')
+            if resume and os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    state = json.load(f)
+                done = _DoneIndices(state['watermark'], state['done'])
+                ous.resume(state['ous'])
+        checkpointer = _Checkpointer(checkpoint, checkpoint_interval) if checkpoint is not None else None
 
-        read_worker = mp.Process(target=self._read_worker, args=(ins, inq))
-        produce_workers = [mp.Process(target=self._produce_worker, args=(flow, ous.requires, inq, ouq))
-                           for _ in range(self._num_workers)]
-        write_worker = mp.Process(target=self._write_worker, args=(ouq, ous, keep_order, pbar))
+        ouq = self._new_results(flow, ous.requires)
+        statq = mp.Queue() if self._profile else None
+        progress = _WriteProgress(self._reorder_window)
+        counters = self._new_counters(ins, metrics is not None)
 
-        write_worker.start()
-        for w in produce_workers:
+        # the progress bar follows the first writer only
+        parts = self._parts(ous, keep_order, checkpointer)
+        write_cls = threading.Thread if self._persistent else mp.Process
+        write_workers = [write_cls(target=self._write_worker,
+                                   args=(ouq, part, keep_order, pbar if i == 0 else 'none', progress,
+                                         checkpointer, counters, done))
+                         for i, part in enumerate(parts if parts is not None else [ous])]
+        for w in write_workers:
             w.start()
-        read_worker.start()
 
-        read_worker.join()
-        for _ in range(len(produce_workers)):
-            inq.put((-1, None))
+        run = self._start_workers(flow, ous.requires, ins, ouq, progress, done, statq, counters)
+
+        sampler = None
+        if metrics is not None:
+            sampler = _MetricsSampler(metrics, metrics_interval, counters, run.inq, ouq)
+            sampler.start()
 
-        for w in produce_workers:
+        self._finish_workers(run, statq, counters)
+
+        for _ in write_workers:
+            ouq.put(None)
+        for w in write_workers:
             w.join()
 
-        ouq.put((-1, None))
-        write_worker.join()
+        if sampler is not None:
+            sampler.stop()
 
-    # noinspection PyMethodMayBeStatic
-    def _read_worker(self, ins: InStream, inq: mp.Queue):
+        if parts is not None and self._merge_parts:
+            typing.cast(Shardable, ous).merge(parts)
+
+        self._transport.clear()
+
+    # Runs the flow like produce, but yields the result dicts to the caller
+    # instead of passing them to a writer process. `prefetch` bounds how many
+    # items, in whole chunks, are produced ahead of the consumer; 0 leaves it
+    # to the queues and reorder_window. Closing the iterator early stops the
+    # reader and lets the workers run dry.
+    def iter_results(self,
+                     flow: BaseDataFlow,
+                     ins: InStream,
+                     targets: Union[str, Sequence[str]],
+                     keep_order: bool = False,
+                     prefetch: int = 0) -> Iterator[Dict[str, Any]]:
+        assert prefetch >= 0
+        targets = _trans_str_seq(targets)
+        windows = [w for w in (self._reorder_window, prefetch) if w > 0]
+
+        ouq = self._new_results(flow, targets)
+        statq = mp.Queue() if self._profile else None
+        progress = _WriteProgress(min(windows, default=0))
+        counters = self._new_counters(ins, False)
+        run = self._start_workers(flow, targets, ins, ouq, progress, _DoneIndices(), statq, counters)
+
+        def finish():
+            self._finish_workers(run, statq, counters)
+            ouq.put(None)
+        finisher = threading.Thread(target=finish, daemon=True)
+        finisher.start()
+
+        buf = []
+        offset = 0
+        finished = False
+        try:
+            while True:
+                chunk = ouq.get()
+                if chunk is None:
+                    break
+                heapq.heappush(buf, chunk)
+                while len(buf) > 0 and (not keep_order or buf[0][0] == offset):
+                    _, span, items = heapq.heappop(buf)
+                    if counters is not None:
+                        counters.write(len(items), 0.0, sum(len(c[2]) for c in buf))
+                    yield from self._detach_items(items)
+                    offset += span
+                    progress.advance(span)
+            finished = True
+            finisher.join()
+        finally:
+            if not finished:
+                progress.stop()
+                # workers may be blocked on a full ouq, keep emptying it
+                while finisher.is_alive():
+                    self._drain(ouq)
+                    finisher.join(0.05)
+                self._drain(ouq)
+                for _, _, items in buf:
+                    self._transport.release(self._transport.unpack(items)[1])
+            self._transport.clear()
+
+    # operation stats of the last produce run, None unless profiling
+    @property
+    def profiler(self) -> Optional[Profiler]:
+        return self._profiler
+
+    # the queue the results of a run arrive on, a job of the pool when the
+    # workers are persistent
+    def _new_results(self, flow: BaseDataFlow, targets: Sequence[str]) -> Union[mp.Queue, '_PoolJob']:
+        if not self._persistent:
+            return mp.Queue(self._max_queue_size)
+        if self._pool is not None and not self._pool.serves(flow):
+            self.close()
+        if self._pool is None:
+            self._pool = _WorkerPool(self, flow, self._num_workers, self._max_queue_size)
+        return self._pool.new_job(targets)
+
+    # one part per writer, or None to write to the stream itself. Only
+    # unordered runs without a checkpoint are sharded, by separate processes.
+    def _parts(self,
+               ous: OutStream,
+               keep_order: bool,
+               checkpointer: Optional['_Checkpointer']) -> Optional[List[OutStream]]:
+        if (self._num_writers <= 1 or self._persistent or keep_order or checkpointer is not None
+                or not isinstance(ous, Shardable)):
+            return None
+        return [ous.part(i) for i in range(self._num_writers)]
+
+    def _splits(self, ins: InStream) -> bool:
+        return self._split_input and isinstance(ins, Splittable)
+
+    def _new_counters(self, ins: InStream, metrics: bool) -> Optional['_Metrics']:
+        # only the reader fed mode scales, split workers each drain their own shards
+        autoscale = self._max_workers > 0 and not self._splits(ins)
+        if not metrics and not autoscale:
+            return None
+
+        counters = _Metrics(self._max_workers if autoscale else self._num_workers)
+        counters.set_workers(self._num_workers)
+        return counters
+
+    def _start_workers(self,
+                       flow: BaseDataFlow,
+                       targets: Sequence[str],
+                       ins: InStream,
+                       ouq: mp.Queue,
+                       progress: '_WriteProgress',
+                       done: '_DoneIndices',
+                       statq: Optional[mp.Queue],
+                       counters: Optional['_Metrics']) -> '_Workers':
+        num_workers = self._num_workers
+        if isinstance(ouq, _PoolJob):
+            # the produce workers are already running
+            inq = ouq.inq
+            read_worker = threading.Thread(target=self._read_worker, args=(ins, inq, progress, done, counters))
+            spawn = None
+            num_workers = 0
+        elif self._splits(ins):
+            # a few shards per worker so a slow shard does not hold up the tail
+            inq = mp.Queue()
+            for shard in typing.cast(Splittable, ins).shards(4 * self._num_workers):
+                inq.put(shard)
+            read_worker = None
+
+            def spawn(wid: int) -> mp.Process:
+                return mp.Process(target=self._split_produce_worker,
+                                  args=(flow, targets, ins, inq, ouq, progress, done, statq, counters, wid))
+        else:
+            inq = mp.Queue(self._max_queue_size)
+            read_worker = mp.Process(target=self._read_worker, args=(ins, inq, progress, done, counters))
+
+            def spawn(wid: int) -> mp.Process:
+                return mp.Process(target=self._produce_worker,
+                                  args=(flow, targets, inq, ouq, statq, counters, wid, progress))
+
+        run = _Workers(inq, ouq, read_worker, [spawn(i) for i in range(num_workers)], spawn)
+        for w in run.workers:
+            w.start()
+        if read_worker is not None:
+            read_worker.start()
+        return run
+
+    # Waits for the input to be consumed, then sends the sentinels and waits
+    # for the workers to exit.
+    def _finish_workers(self, run: '_Workers', statq: Optional[mp.Queue], counters: Optional['_Metrics']):
+        active = len(run.workers)
+        if run.read_worker is not None:
+            if self._max_workers > 0:
+                # started workers are appended to run.workers
+                active = self._autoscale_workers(run.read_worker, run.workers, run.spawn,
+                                                 run.inq, run.ouq, counters)
+            run.read_worker.join()
+        for _ in range(active):
+            run.inq.put(None)
+
+        if statq is not None:
+            # drained before joining, a worker exits only once its stats are sent
+            self._profiler = Profiler()
+            for _ in range(len(run.workers)):
+                self._profiler.merge(statq.get())
+
+        for w in run.workers:
+            w.join()
+
+    def _drain(self, q: Union[mp.Queue, '_PoolJob']):
+        if isinstance(q, _PoolJob):
+            # the pool queues are shared with later runs, so every result of
+            # this one has to be taken off
+            while True:
+                chunk = q.get()
+                if chunk is None:
+                    return
+                _, refs = self._transport.unpack(chunk[2])
+                self._transport.release(refs)
+
+        while True:
+            try:
+                chunk = q.get_nowait()
+            except queue.Empty:
+                return
+            if chunk is not None:
+                _, refs = self._transport.unpack(chunk[2])
+                self._transport.release(refs)
+
+    # unpacked arrays are views of the transport's buffers, which are reused
+    # once released, so whatever leaves the producer gets copied out
+    def _detach_items(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        items, refs = self._transport.unpack(items)
+        if len(refs) > 0:
+            _copy_arrays(items)
+            self._transport.release(refs)
+        return items
+
+    # Runs in the parent while the reader is alive. Every _SCALE_INTERVAL the
+    # input backlog, the busy time of the workers and the write rate are
+    # sampled, and a worker is started or retired as the _Autoscaler decides.
+    # A retired worker is sent a sentinel, so whichever takes it exits. Returns
+    # how many workers still need a sentinel.
+    def _autoscale_workers(self,
+                           read_worker: mp.Process,
+                           workers: List[mp.Process],
+                           spawn: Callable[[int], mp.Process],
+                           inq: mp.Queue,
+                           ouq: mp.Queue,
+                           metrics: '_Metrics') -> int:
+        scaler = _Autoscaler(self._min_workers, self._max_workers)
+        running = {wid: w for wid, w in enumerate(workers)}
+        active = len(workers)
+
+        last, last_time = metrics.snapshot(), time.perf_counter()
+        while True:
+            read_worker.join(self._SCALE_INTERVAL)
+            if not read_worker.is_alive():
+                return active
+
+            backlog, out_backlog = _qsize(inq), _qsize(ouq)
+            if backlog is None or out_backlog is None:
+                # nothing to decide on, keep the workers as they are
+                return active
+
+            now, sample = time.perf_counter(), metrics.snapshot()
+            elapsed = max(now - last_time, 1e-9)
+            busy = sum(b - a for a, b in zip(last['worker_busy'], sample['worker_busy']))
+            rate = (sample['rows_written'] - last['rows_written']) / elapsed
+            last, last_time = sample, now
+
+            for wid, w in list(running.items()):
+                if not w.is_alive():
+                    del running[wid]
+
+            target = scaler.decide(active, backlog, out_backlog >= self._max_queue_size,
+                                   busy / (elapsed * active), rate)
+            if target > active:
+                # the busy slot of a retired worker is reused once it has exited
+                wid = next((i for i in range(self._max_workers) if i not in running), None)
+                if wid is not None:
+                    w = spawn(wid)
+                    w.start()
+                    workers.append(w)
+                    running[wid] = w
+                    active += 1
+            elif target < active:
+                inq.put(None)
+                active -= 1
+            metrics.set_workers(active)
+
+    def _new_pipe(self, flow: BaseDataFlow) -> Pipeline:
+        pipe = self._pipe_cls(flow)
+        if self._profile:
+            pipe.enable_profiling()
+        return pipe
+
+    def _read_worker(self,
+                     ins: InStream,
+                     inq: mp.Queue,
+                     progress: '_WriteProgress',
+                     done: '_DoneIndices',
+                     metrics: Optional['_Metrics'] = None):
         with ins:
-            for i, item in enumerate(ins.iter_items()):
-                inq.put((i, item))
+            items = done.skip(ins.iter_indexed_items())
+            for start, span, chunk in self._iter_chunks(items, 0, None, inq):
+                chunk = self._transport.pack(chunk)
+                stalled = time.perf_counter()
+                progress.wait_for_window(start)
+                if progress.stopped:
+                    self._transport.release(self._transport.unpack(chunk)[1])
+                    break
+                inq.put((start, span, chunk))
+                if metrics is not None:
+                    metrics.read(len(chunk), time.perf_counter() - stalled)
+
+    # Groups (index, item) pairs into (start, span, items) chunks. The spans tile
+    # [begin, end) even where indices are missing, so keep_order never waits for
+    # an index that will not come.
+    def _iter_chunks(self,
+                     indexed_items: Iterable[Tuple[int, Dict[str, Any]]],
+                     begin: int,
+                     end: Optional[int],
+                     inq: Optional[mp.Queue]) -> Iterator[Tuple[int, int, List[Dict[str, Any]]]]:
+        size = self._next_chunk_size(0, inq)
+        start, stop, chunk = begin, begin, []
+
+        for i, item in indexed_items:
+            chunk.append(item)
+            stop = i + 1
+            if len(chunk) >= size:
+                yield start, stop - start, chunk
+                start, chunk = stop, []
+                size = self._next_chunk_size(size, inq)
+
+        if end is not None:
+            stop = end
+        if len(chunk) > 0 or stop > start:
+            yield start, stop - start, chunk
+
+    def _next_chunk_size(self, size: int, inq: Optional[mp.Queue]) -> int:
+        size = self._adapt_chunk_size(size, inq)
+        # chunks larger than the window would let the reorder buffer outgrow it
+        if self._reorder_window > 0:
+            size = min(size, self._reorder_window)
+        return size
+
+    def _adapt_chunk_size(self, size: int, inq: Optional[mp.Queue]) -> int:
+        if self._chunk_size > 0:
+            return self._chunk_size
+        if inq is None:
+            return self._FALLBACK_CHUNK_SIZE
+        if size == 0:
+            return 1
+
+        try:
+            backlog = inq.qsize()
+        except NotImplementedError:
+            return self._FALLBACK_CHUNK_SIZE
+
+        # workers are saturated, so larger chunks cost no latency; when they
+        # starve, smaller chunks spread the remaining items more evenly
+        if backlog > 2 * self._num_workers:
+            return min(size * 2, self._MAX_CHUNK_SIZE)
+        elif backlog < self._num_workers:
+            return max(size // 2, 1)
+        return size
 
     def _produce_worker(self,
                         flow: BaseDataFlow,
                         targets: Sequence[str],
                         inq: mp.Queue,
-                        ouq: mp.Queue):
-        pipe = self._pipe_cls(flow)
+                        ouq: mp.Queue,
+                        statq: Optional[mp.Queue] = None,
+                        metrics: Optional['_Metrics'] = None,
+                        wid: int = 0,
+                        progress: Optional['_WriteProgress'] = None):
+        pipe = self._new_pipe(flow)
+
+        # the stats are sent even when an operation fails, the parent waits for them
+        try:
+            while True:
+                chunk = inq.get()
+                if chunk is None:
+                    break
+                n, span, items = chunk
+                items, refs = self._transport.unpack(items)
+                if progress is not None and progress.stopped:
+                    # keep taking chunks until the sentinel, so the queue never blocks
+                    del items, chunk
+                    self._transport.release(refs)
+                    continue
+                busy = time.perf_counter()
+                outs = self._produce_chunk(pipe, targets, items)
+                if metrics is not None:
+                    metrics.work(wid, time.perf_counter() - busy)
+                if len(refs) > 0:
+                    # outputs too small to be packed may still be views of the
+                    # inputs, and the queue pickles them only after the release
+                    _copy_arrays(outs)
+                del items, chunk
+                self._transport.release(refs)
+                ouq.put((n, span, outs))
+        finally:
+            if statq is not None:
+                statq.put(pipe.profiler)
+
+    # Runs the chunks of any number of runs until the pool is closed, each
+    # chunk tagged with the targets of its run.
+    def _pool_worker(self, flow: BaseDataFlow, inq: mp.Queue, ouq: mp.Queue):
+        pipe = self._new_pipe(flow)
 
         while True:
-            n, item = inq.get()
-            if n < 0:
+            chunk = inq.get()
+            if chunk is None:
                 break
-            result = pipe.product(targets, item)
-            out = {k: v for k, v in zip(targets, result)}
-            ouq.put((n, out))
+            targets, (n, span, items) = chunk
+            items, refs = self._transport.unpack(items)
+            outs = self._produce_chunk(pipe, targets, items)
+            if len(refs) > 0:
+                _copy_arrays(outs)
+            del items, chunk
+            self._transport.release(refs)
+            ouq.put((n, span, outs))
+
+    def _split_produce_worker(self,
+                              flow: BaseDataFlow,
+                              targets: Sequence[str],
+                              ins: InStream,
+                              shardq: mp.Queue,
+                              ouq: mp.Queue,
+                              progress: '_WriteProgress',
+                              done: '_DoneIndices',
+                              statq: Optional[mp.Queue] = None,
+                              metrics: Optional['_Metrics'] = None,
+                              wid: int = 0):
+        pipe = self._new_pipe(flow)
+        ins = typing.cast(Splittable, ins)
 
-    # noinspection PyMethodMayBeStatic
-    def _write_worker(self, ouq: mp.Queue, ous: OutStream, keep_order: bool, pbar_tp: str):
         try:
-            # noinspection PyPackageRequirements,PyUnresolvedReferences
-            from tqdm import tqdm, tqdm_notebook
-
-            if pbar_tp == 'none':
-                pbar_cls = _FakePbar
-            elif pbar_tp == 'notebook':
-                pbar_cls = tqdm_notebook
-            elif pbar_tp == 'terminal':
-                pbar_cls = tqdm
-            else:
-                raise ValueError('un-support pbar: {}'.format(pbar_tp))
-        except ImportError:
-            pbar_cls = _FakePbar
+            with typing.cast(InStream, ins):
+                while True:
+                    shard = shardq.get()
+                    if shard is None:
+                        break
+                    if progress.stopped:
+                        continue
+                    shard = typing.cast(InShard, shard)
+                    stop = None if shard.count is None else shard.start + shard.count
+
+                    # a finished shard is not even parsed, one empty chunk covers its span
+                    finished = stop is not None and done.covers(shard.start, stop)
+                    items = () if finished else done.skip(ins.iter_shard(shard))
+                    for n, span, items in self._iter_chunks(items, shard.start, stop, None):
+                        progress.wait_for_window(n)
+                        if progress.stopped:
+                            break
+                        busy = time.perf_counter()
+                        outs = self._produce_chunk(pipe, targets, items)
+                        if metrics is not None:
+                            metrics.read(len(items), 0.0)
+                            metrics.work(wid, time.perf_counter() - busy)
+                        ouq.put((n, span, outs))
+        finally:
+            if statq is not None:
+                statq.put(pipe.profiler)
+
+    def _produce_chunk(self,
+                       pipe: Pipeline,
+                       targets: Sequence[str],
+                       items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = pipe.product_batch(targets, items)
+        outs = [{k: v for k, v in zip(targets, result)} for result in results]
+        return self._transport.pack(outs)
+
+    # noinspection PyMethodMayBeStatic
+    def _write_worker(self,
+                      ouq: mp.Queue,
+                      ous: OutStream,
+                      keep_order: bool,
+                      pbar_tp: str,
+                      progress: '_WriteProgress',
+                      checkpointer: Optional['_Checkpointer'] = None,
+                      metrics: Optional['_Metrics'] = None,
+                      done: Optional['_DoneIndices'] = None):
+        pbar_cls = _get_pbar_cls(pbar_tp)
 
         buf = []
+        buffered = 0
         offset = 0
+        # starts from the indices a resumed run already has, an unordered run
+        # may save a checkpoint before the chunks spanning them come back
+        done = _DoneIndices(done.watermark, done.ranges()) if done is not None else _DoneIndices()
 
         with ous, pbar_cls() as pbar:
             while True:
-                n, item = ouq.get()
-                if n < 0:
+                stalled = time.perf_counter()
+                chunk = ouq.get()
+                stalled = time.perf_counter() - stalled
+                if chunk is None:
                     break
+                n, span, items = chunk
+                written = 0
                 if not keep_order:
-                    ous.put_item(item)
+                    self._write_items(ous, items)
+                    progress.advance(span)
+                    done.add(n, span)
+                    written = len(items)
                 else:
-                    heapq.heappush(buf, (n, item))
+                    heapq.heappush(buf, (n, span, items))
+                    buffered += len(items)
                     while len(buf) > 0 and buf[0][0] == offset:
-                        _, item = heapq.heappop(buf)
-                        ous.put_item(item)
-                        offset += 1
-                pbar.update(1)
+                        n, span, ready = heapq.heappop(buf)
+                        self._write_items(ous, ready)
+                        offset += span
+                        progress.advance(span)
+                        done.add(n, span)
+                        buffered -= len(ready)
+                        written += len(ready)
+                pbar.update(len(items))
+
+                if metrics is not None:
+                    metrics.write(written, stalled, buffered)
+
+                if checkpointer is not None:
+                    checkpointer.save(ous, done)
+
+            if checkpointer is not None:
+                checkpointer.save(ous, done, force=True)
+
+    # sinks may buffer the items, so they get copies like iter_results does
+    def _write_items(self, ous: OutStream, items: List[Dict[str, Any]]):
+        for item in self._detach_items(items):
+            ous.put_item(item)
+
+
+# Number of items written so far, shared so the reader can stall when it runs
+# more than `window` items ahead of the writer.
+class _WriteProgress(object):
+    def __init__(self, window: int = 0):
+        self._window = window
+        self._written = mp.Value('q', 0, lock=False)
+        self._stopped = mp.Value('b', 0, lock=False)
+        self._cond = mp.Condition()
+
+    @property
+    def written(self) -> int:
+        return self._written.value
+
+    # set once the consumer has gone away: the reader stops and the workers
+    # drop the chunks still queued
+    @property
+    def stopped(self) -> bool:
+        return bool(self._stopped.value)
+
+    def stop(self):
+        with self._cond:
+            self._stopped.value = 1
+            self._cond.notify_all()
+
+    # blocks until a chunk starting at `start` is at most `window` items ahead
+    def wait_for_window(self, start: int):
+        if self._window <= 0:
+            return
+
+        with self._cond:
+            while start - self._written.value >= self._window and not self._stopped.value:
+                self._cond.wait()
+
+    def advance(self, n: int):
+        with self._cond:
+            self._written.value += n
+            self._cond.notify_all()
+
+
+# The reader and produce workers of one ParallelProducer run. `spawn(wid)`
+# creates one more produce worker.
+class _Workers(object):
+    def __init__(self,
+                 inq: mp.Queue,
+                 ouq: mp.Queue,
+                 read_worker: Optional[mp.Process],
+                 workers: List[mp.Process],
+                 spawn: Callable[[int], mp.Process]):
+        self.inq = inq
+        self.ouq = ouq
+        self.read_worker = read_worker
+        self.workers = workers
+        self.spawn = spawn
+
+
+# Produce workers shared by the runs of a persistent ParallelProducer. They are
+# forked with the flow, so it is never pickled, and keep its pipeline, so the
+# route caches stay warm. Only a frozen flow can not change under them, any
+# other flow gets a new pool every run.
+class _WorkerPool(object):
+    def __init__(self, producer: ParallelProducer, flow: BaseDataFlow, num_workers: int, max_queue_size: int):
+        self.flow = flow
+        self.inq = mp.Queue(max_queue_size)
+        self.ouq = mp.Queue(max_queue_size)
+        self._workers = [mp.Process(target=producer._pool_worker, args=(flow, self.inq, self.ouq), daemon=True)
+                         for _ in range(num_workers)]
+        for w in self._workers:
+            w.start()
+
+    def serves(self, flow: BaseDataFlow) -> bool:
+        return flow is self.flow and flow.frozen
+
+    def new_job(self, targets: Sequence[str]) -> '_PoolJob':
+        return _PoolJob(self, targets)
+
+    def close(self):
+        for _ in self._workers:
+            self.inq.put(None)
+        for w in self._workers:
+            w.join()
+
+
+# One run on a _WorkerPool. The chunks put to `inq` carry the targets of the
+# run and are counted; put(None) stands in for the sentinel of a per-run
+# result queue, get returns None once a result came back for every chunk sent.
+class _PoolJob(object):
+    def __init__(self, pool: _WorkerPool, targets: Sequence[str]):
+        self.inq = _TaggedQueue(pool.inq, tuple(targets))
+        self._ouq = pool.ouq
+        self._expected = None
+        self._received = 0
+
+    def put(self, chunk: None):
+        assert chunk is None
+        self._ouq.put(self.inq.sent)
+
+    def get(self) -> Optional[Tuple[int, int, List[Dict[str, Any]]]]:
+        while self._expected is None or self._received < self._expected:
+            chunk = self._ouq.get()
+            if isinstance(chunk, int):
+                self._expected = chunk
+                continue
+            self._received += 1
+            return chunk
+        return None
+
+    def qsize(self) -> int:
+        return self._ouq.qsize()
+
+
+class _TaggedQueue(object):
+    def __init__(self, q: mp.Queue, tag: Any):
+        self._q = q
+        self._tag = tag
+        self.sent = 0
+
+    def put(self, chunk: Tuple[int, int, List[Dict[str, Any]]]):
+        self._q.put((self._tag, chunk))
+        self.sent += 1
+
+    def qsize(self) -> int:
+        return self._q.qsize()
+
+
+# Cumulative counters updated by the producer processes and read by the
+# metrics sampler. Reads are not synchronized, so a sample may be off by a chunk.
+class _Metrics(object):
+    def __init__(self, num_workers: int):
+        self._rows_read = mp.Value('q', 0)
+        self._rows_written = mp.Value('q', 0)
+        self._reorder_buffer = mp.Value('q', 0, lock=False)
+        self._reader_stall = mp.Value('d', 0.0, lock=False)
+        self._writer_stall = mp.Value('d', 0.0, lock=False)
+        self._worker_busy = mp.Array('d', num_workers, lock=False)
+        self._workers = mp.Value('i', num_workers, lock=False)
+
+    # split workers read and sharded runs have several writers, so these
+    # counters are updated from several processes
+    def read(self, rows: int, stall: float):
+        with self._rows_read.get_lock():
+            self._rows_read.value += rows
+        self._reader_stall.value += stall
+
+    def work(self, wid: int, busy: float):
+        self._worker_busy[wid] += busy
+
+    def set_workers(self, n: int):
+        self._workers.value = n
+
+    def write(self, rows: int, stall: float, buffered: int):
+        with self._rows_written.get_lock():
+            self._rows_written.value += rows
+            self._writer_stall.value += stall
+        self._reorder_buffer.value = buffered
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(rows_read=self._rows_read.value,
+                    rows_written=self._rows_written.value,
+                    reorder_buffer=self._reorder_buffer.value,
+                    reader_stall=self._reader_stall.value,
+                    writer_stall=self._writer_stall.value,
+                    worker_busy=list(self._worker_busy),
+                    workers=self._workers.value)
+
+
+# Samples _Metrics every `interval` seconds from a thread of the parent and
+# hands each sample to a callback or appends it as a line to a JSONL file.
+class _MetricsSampler(object):
+    def __init__(self,
+                 sink: Union[str, Callable[[Dict[str, Any]], None]],
+                 interval: float,
+                 metrics: _Metrics,
+                 inq: mp.Queue,
+                 ouq: mp.Queue):
+        assert interval > 0
+        self._sink = sink
+        self._interval = interval
+        self._metrics = metrics
+        self._inq = inq
+        self._ouq = ouq
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._file = None
+        self._start = 0.0
+        self._last = (0.0, 0)
+
+    def start(self):
+        if isinstance(self._sink, str):
+            self._file = open(self._sink, 'a')
+        self._start = time.perf_counter()
+        self._last = (self._start, 0)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._emit(final=True)
+        if self._file is not None:
+            self._file.close()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self._emit()
+
+    def _emit(self, final: bool = False):
+        now = time.perf_counter()
+        sample = self._metrics.snapshot()
+
+        last_time, last_rows = self._last
+        self._last = (now, sample['rows_written'])
+
+        elapsed = now - self._start
+        sample.update(time=time.time(),
+                      elapsed=elapsed,
+                      rows_per_sec=(sample['rows_written'] - last_rows) / max(now - last_time, 1e-9),
+                      inq_depth=_qsize(self._inq),
+                      ouq_depth=_qsize(self._ouq),
+                      worker_idle=[max(elapsed - busy, 0.0) for busy in sample['worker_busy']],
+                      final=final)
+
+        if self._file is not None:
+            self._file.write(json.dumps(sample) + '\n')
+            self._file.flush()
+        else:
+            self._sink(sample)
+
+
+# Chooses the number of produce workers. A worker is added while the workers
+# are busy, input is waiting and the writer keeps up; it is taken back when
+# the write rate did not grow with it, and then no more are tried for a while
+# since the machine or another stage is the limit. Mostly idle workers are
+# retired one at a time.
+class _Autoscaler(object):
+    _SCALE_UP_UTILIZATION = 0.8
+    _SCALE_DOWN_UTILIZATION = 0.4
+    _MIN_GAIN = 1.05
+    _HOLD_TICKS = 20
+
+    def __init__(self, min_workers: int, max_workers: int):
+        assert 1 <= min_workers <= max_workers
+        self._min_workers = min_workers
+        self._max_workers = max_workers
+        self._ceiling = max_workers
+        self._hold = 0
+        # workers and write rate before the last scale up, still to be judged
+        self._probe = None
+
+    def decide(self, workers: int, backlog: int, writer_full: bool, utilization: float, rate: float) -> int:
+        if self._probe is not None:
+            before, before_rate = self._probe
+            self._probe = None
+            if rate < before_rate * self._MIN_GAIN:
+                self._ceiling, self._hold = before, self._HOLD_TICKS
+                return max(before, self._min_workers)
+
+        if self._hold > 0:
+            self._hold -= 1
+            if self._hold == 0:
+                self._ceiling = self._max_workers
+
+        if (utilization >= self._SCALE_UP_UTILIZATION and backlog >= workers and not writer_full
+                and workers < self._ceiling):
+            self._probe = (workers, rate)
+            return workers + 1
+        if utilization < self._SCALE_DOWN_UTILIZATION and workers > self._min_workers:
+            return workers - 1
+        return workers
+
+
+def _copy_arrays(items: List[Dict[str, Any]]):
+    for item in items:
+        for k, v in item.items():
+            if _is_ndarray(v):
+                item[k] = v.copy()
+
+
+def _qsize(q: mp.Queue) -> Optional[int]:
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+
+# Item indices known to be written: everything below the watermark plus
+# disjoint [start, stop) ranges above it.
+class _DoneIndices(object):
+    def __init__(self, watermark: int = 0, ranges: Sequence[Sequence[int]] = ()):
+        self.watermark = watermark
+        self._stops = {start: stop for start, stop in ranges}
+
+    # spans may overlap ranges known from a resumed run
+    def add(self, start: int, span: int):
+        if span <= 0:
+            return
+
+        stop = start + span
+        if start > self.watermark:
+            self._stops[start] = max(stop, self._stops.get(start, stop))
+            return
+
+        self.watermark = max(self.watermark, stop)
+        while True:
+            reached = [lo for lo in self._stops if lo <= self.watermark]
+            if len(reached) == 0:
+                break
+            for lo in reached:
+                self.watermark = max(self.watermark, self._stops.pop(lo))
+
+    def ranges(self) -> List[List[int]]:
+        merged = []
+        for start, stop in sorted(self._stops.items()):
+            if len(merged) > 0 and merged[-1][1] >= start:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+    def covers(self, start: int, stop: int) -> bool:
+        if stop <= self.watermark:
+            return True
+        return any(lo <= max(start, self.watermark) and stop <= hi for lo, hi in self.ranges())
+
+    def skip(self, indexed_items: Iterable[Tuple[int, Dict[str, Any]]]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        ranges = iter(self.ranges())
+        lo, hi = next(ranges, (None, None))
+
+        for i, item in indexed_items:
+            if i < self.watermark:
+                continue
+            while hi is not None and i >= hi:
+                lo, hi = next(ranges, (None, None))
+            if lo is not None and lo <= i:
+                continue
+            yield i, item
+
+
+# Periodically saves the written indices together with the OutStream state, so
+# a later run can resume after the last checkpoint.
+class _Checkpointer(object):
+    def __init__(self, filename: str, interval: float):
+        self._filename = filename
+        self._interval = interval
+        self._last = time.monotonic()
+
+    def save(self, ous: OutStream, done: _DoneIndices, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last < self._interval:
+            return
+        self._last = now
+
+        state = dict(watermark=done.watermark,
+                     done=done.ranges(),
+                     ous=typing.cast(Resumable, ous).checkpoint())
+
+        tmp = '{}.tmp'.format(self._filename)
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self._filename)
+
+
+class AsyncProducer(Producer):
+    def __init__(self,
+                 max_in_flight: int = 256,
+                 pipe_cls: Optional[Callable[[BaseDataFlow], AsyncPipeline]] = None,
+                 profile: bool = False):
+        assert max_in_flight > 0
+        self._max_in_flight = max_in_flight
+        self._pipe_cls = pipe_cls if pipe_cls is not None else AsyncPipeline
+        self._profile = profile
+        self._profiler = None
+
+    # operation stats of the last produce run, None unless profiling
+    @property
+    def profiler(self) -> Optional[Profiler]:
+        return self._profiler
+
+    def produce(self,
+                flow: BaseDataFlow,
+                ins: InStream,
+                ous: Union[OutStream, Sequence[OutStream]],
+                keep_order: bool = False,
+                pbar: str = 'none'):
+        asyncio.run(self.aproduce(flow, ins, ous, keep_order, pbar))
+
+    async def aproduce(self,
+                       flow: BaseDataFlow,
+                       ins: InStream,
+                       ous: Union[OutStream, Sequence[OutStream]],
+                       keep_order: bool = False,
+                       pbar: str = 'none'):
+        pbar = pbar.lower()
+        assert pbar in {'none', 'terminal', 'notebook'}
+        pbar_cls = _get_pbar_cls(pbar)
+        ous = fan_out(ous)
+
+        pipe = self._pipe_cls(flow)
+        if self._profile:
+            self._profiler = pipe.enable_profiling()
+        targets = ous.requires
+
+        # a slot is held until the item is written, which also bounds the
+        # reorder buffer under keep_order
+        slots = asyncio.Semaphore(self._max_in_flight)
+        pending = set()
+        errors = []
+        buf = []
+        offset = 0
+
+        with ins, ous, pbar_cls() as pbar:
+            async def work(n, item):
+                nonlocal offset
+
+                try:
+                    result = await pipe.aproduct(targets, item)
+
+                    out = {k: v for k, v in zip(targets, result)}
+                    if not keep_order:
+                        ous.put_item(out)
+                        slots.release()
+                    else:
+                        heapq.heappush(buf, (n, out))
+                        while len(buf) > 0 and buf[0][0] == offset:
+                            _, out = heapq.heappop(buf)
+                            ous.put_item(out)
+                            offset += 1
+                            slots.release()
+                    pbar.update(1)
+                except Exception as e:
+                    errors.append(e)
+                    # wakes the reader, which stops at the error
+                    slots.release()
+                    raise
+
+            for i, item in enumerate(ins.iter_items()):
+                await slots.acquire()
+                if len(errors) > 0:
+                    break
+
+                task = asyncio.ensure_future(work(i, item))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if len(errors) > 0:
+                for task in pending:
+                    task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+            if len(errors) > 0:
+                raise errors[0]
+
+
+def _get_pbar_cls(pbar_tp: str) -> Callable:
+    try:
+        # noinspection PyPackageRequirements,PyUnresolvedReferences
+        from tqdm import tqdm, tqdm_notebook
+
+        if pbar_tp == 'none':
+            pbar_cls = _FakePbar
+        elif pbar_tp == 'notebook':
+            pbar_cls = tqdm_notebook
+        elif pbar_tp == 'terminal':
+            pbar_cls = tqdm
+        else:
+            raise ValueError('un-support pbar: {}'.format(pbar_tp))
+    except ImportError:
+        pbar_cls = _FakePbar
+
+    return pbar_cls
 
 
 class _FakePbar(object):
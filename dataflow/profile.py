@@ -0,0 +1,125 @@
+import math
+import functools
+import threading
+
+from typing import Any, Dict, Optional, Callable
+
+from .flow import Operation, Factory
+
+
+# Latency statistics of one operation. Latencies are counted in logarithmic
+# buckets, a few percent wide, so percentiles are approximate but the stats
+# stay small and can be merged across processes.
+class OpStats(object):
+    _BUCKETS_PER_OCTAVE = 16
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self._buckets: Dict[int, int] = {}
+
+    def record(self, elapsed: float, failed: bool = False):
+        self.count += 1
+        self.errors += int(failed)
+        self.total += elapsed
+        self.min = min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+
+        bucket = math.floor(math.log2(max(elapsed, 1e-9)) * self._BUCKETS_PER_OCTAVE)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def merge(self, other: 'OpStats'):
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for bucket, n in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + n
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, q: float) -> float:
+        assert 0 <= q <= 100
+        if self.count == 0:
+            return 0.0
+
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                upper = 2 ** ((bucket + 1) / self._BUCKETS_PER_OCTAVE)
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(count=self.count, errors=self.errors, total=self.total, mean=self.mean,
+                    min=self.min if self.count > 0 else 0.0, max=self.max,
+                    p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+
+# Collects OpStats per operation through the post-operation hook of a
+# pipeline. Operations are named after their function and the fields they
+# output, so profilers filled in different processes can be merged.
+class Profiler(object):
+    def __init__(self):
+        self._stats: Dict[str, OpStats] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def post(self, op: Operation, elapsed: float, exc: Optional[BaseException]):
+        name = _op_name(op)
+        with self._lock:
+            stats = self._stats.get(name, None)
+            if stats is None:
+                stats = self._stats[name] = OpStats()
+            stats.record(elapsed, exc is not None)
+
+    def merge(self, other: 'Profiler'):
+        with self._lock:
+            for name, stats in other.stats.items():
+                self._stats.setdefault(name, OpStats()).merge(stats)
+
+    @property
+    def stats(self) -> Dict[str, OpStats]:
+        return dict(self._stats)
+
+    def clear(self):
+        with self._lock:
+            self._stats = {}
+
+    # operations sorted by total time, most expensive first
+    def report(self) -> str:
+        lines = ['{:<48} {:>9} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+            'operation', 'calls', 'errors', 'total(s)', 'p50(ms)', 'p90(ms)', 'p99(ms)')]
+        for name, stats in sorted(self.stats.items(), key=lambda kv: -kv[1].total):
+            lines.append('{:<48} {:>9} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                name, stats.count, stats.errors, stats.total,
+                stats.percentile(50) * 1e3, stats.percentile(90) * 1e3, stats.percentile(99) * 1e3))
+        return '\n'.join(lines)
+
+
+# module.qualname -> fields; the fields keep operations sharing a lambda,
+# partial or builtin apart
+def _op_name(op: Operation) -> str:
+    fn: Callable = op.fn
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    module = getattr(fn, '__module__', None) or type(fn).__module__
+    qualname = getattr(fn, '__qualname__', None) or type(fn).__qualname__
+    fields = op.provides if isinstance(op, Factory) else op.fields
+    return '{}.{} -> {}'.format(module, qualname, ','.join(fields))
@@ -1,8 +1,18 @@
+import io
 import os
 import re
+import csv
+import mmap
+import pickle
+import shutil
+import struct
+import typing
+import contextlib
 
 from abc import ABCMeta, abstractmethod
-from typing import Iterable, Dict, Any, Sequence, Mapping, Optional
+from typing import Iterable, Dict, Any, Sequence, Mapping, Optional, Tuple, List, BinaryIO, Union
+
+from .compression import open_compressed, _compression_of, _split_ext, _sync
 
 
 class Stream(metaclass=ABCMeta):
@@ -24,6 +34,11 @@ class InStream(Stream, metaclass=ABCMeta):
     def iter_items(self) -> Iterable[Dict[str, Any]]:
         pass
 
+    # yields (index, item) with the indices iter_shard of a Splittable stream
+    # gives the same items, so checkpoints of split and unsplit runs agree
+    def iter_indexed_items(self) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        return enumerate(self.iter_items())
+
 
 class OutStream(Stream, metaclass=ABCMeta):
     @abstractmethod
@@ -36,6 +51,50 @@ class OutStream(Stream, metaclass=ABCMeta):
         pass
 
 
+class InShard(object):
+    # a slice of an input holding the global item indices [start, start + count),
+    # or every index from start on when count is None
+    def __init__(self, start: int, count: Optional[int]):
+        self.start = start
+        self.count = count
+
+
+class Splittable(metaclass=ABCMeta):
+    @abstractmethod
+    def shards(self, n: int) -> Sequence[InShard]:
+        pass
+
+    # yields (global index, item) in increasing index order; indices of the
+    # shard that yield no item (e.g. blank lines) are simply skipped
+    @abstractmethod
+    def iter_shard(self, shard: InShard) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        pass
+
+
+class Resumable(metaclass=ABCMeta):
+    # flushes and returns a JSON-serializable state the stream can resume from
+    @abstractmethod
+    def checkpoint(self) -> Any:
+        pass
+
+    # drops whatever was written after the checkpoint, the next enter appends
+    @abstractmethod
+    def resume(self, state: Any):
+        pass
+
+
+class Shardable(metaclass=ABCMeta):
+    # a stream of its own for writer `index` of a sharded run
+    @abstractmethod
+    def part(self, index: int) -> OutStream:
+        pass
+
+    # joins the parts, in order, into this stream's own output and removes them
+    @abstractmethod
+    def merge(self, parts: Sequence[OutStream]):
+        pass
+
+
 class Closer(metaclass=ABCMeta):
     @abstractmethod
     def close(self):
@@ -48,16 +107,109 @@ class Flusher(metaclass=ABCMeta):
         pass
 
 
-class CsvReadStream(InStream, Closer):
-    def __init__(self, filename: str, sep: str = ','):
+# Writes every item to several OutStreams, so a producer computes the union of
+# their columns once. Items are passed on whole, each sink picks its own
+# columns.
+class FanOutStream(OutStream, Flusher):
+    def __init__(self, sinks: Sequence[OutStream]):
+        assert len(sinks) > 0
+        self._sinks = list(sinks)
+        self._requires = []
+        for sink in self._sinks:
+            for col in sink.requires:
+                if col not in self._requires:
+                    self._requires.append(col)
+        self._stack = None
+
+    def enter(self):
+        assert self._stack is None
+        with contextlib.ExitStack() as stack:
+            for sink in self._sinks:
+                stack.enter_context(sink)
+            self._stack = stack.pop_all()
+        return self
+
+    def exit(self, exc_type, exc_val, exc_tb):
+        stack, self._stack = self._stack, None
+        if stack is not None:
+            stack.__exit__(exc_type, exc_val, exc_tb)
+
+    def put_item(self, item: Dict[str, Any]):
+        for sink in self._sinks:
+            sink.put_item(item)
+
+    @property
+    def requires(self) -> Sequence[str]:
+        return self._requires
+
+    @property
+    def sinks(self) -> List[OutStream]:
+        return list(self._sinks)
+
+    def flush(self):
+        for sink in self._sinks:
+            if isinstance(sink, Flusher):
+                sink.flush()
+
+
+class _ResumableFanOutStream(FanOutStream, Resumable):
+    def checkpoint(self) -> List[Any]:
+        return [typing.cast(Resumable, sink).checkpoint() for sink in self._sinks]
+
+    def resume(self, state: List[Any]):
+        assert len(state) == len(self._sinks)
+        for sink, sink_state in zip(self._sinks, state):
+            typing.cast(Resumable, sink).resume(sink_state)
+
+
+# One OutStream for one or several sinks; resumable when all of them are.
+def fan_out(sinks: Union[OutStream, Sequence[OutStream]]) -> OutStream:
+    if isinstance(sinks, OutStream):
+        return sinks
+    if len(sinks) == 1:
+        return sinks[0]
+    if all(isinstance(sink, Resumable) for sink in sinks):
+        return _ResumableFanOutStream(sinks)
+    return FanOutStream(sinks)
+
+
+class CsvReadStream(InStream, Splittable, Closer):
+    # engine 'regex' is the original line-by-line parser, which keeps the
+    # quotes of quoted fields. 'csv' parses with the stdlib csv module and is
+    # several times faster: it handles quoted separators and embedded newlines
+    # and strips the double quotes, but single quotes are plain characters and
+    # sep must be one character. Files ending in .gz, .bz2 or .xz are
+    # decompressed on the fly.
+    def __init__(self,
+                 filename: str,
+                 sep: str = ',',
+                 engine: str = 'regex',
+                 buffer_size: int = 1024 * 1024):
+        if engine not in {'csv', 'regex'}:
+            raise ValueError('un-support engine: {}'.format(engine))
+        if engine == 'csv' and len(sep) != 1:
+            raise ValueError('the csv engine only supports single-character separators')
+
         self._filename = filename
+        self._compression = _compression_of(filename)
         self._csv = None
         self._sep = sep
+        self._engine = engine
+        self._buffer_size = buffer_size
         self._cols_title = None
         self._regex = re.compile(r'(".*"|\'.*\'|.*?)({}|\n|$)'.format(sep))
 
     def _open_csv(self):
-        self._csv = open(self._filename, 'r')
+        newline = '' if self._engine == 'csv' else None
+        self._csv = open_compressed(self._filename, 'r', buffering=self._buffer_size, newline=newline)
+
+    # a compressed file can not seek, it is read again from the start
+    def _rewind(self):
+        if self._compression is None:
+            self._csv.seek(0)
+        else:
+            self._csv.close()
+            self._open_csv()
 
     def _parse_line(self, line: str):
         cols = self._regex.findall(line)
@@ -80,15 +232,131 @@ class CsvReadStream(InStream, Closer):
         self.close()
 
     def iter_items(self) -> Iterable[Dict[str, Any]]:
+        for _, item in self.iter_indexed_items():
+            yield item
+
+    # rows are numbered by their line after the title, as in iter_shard, so
+    # blank lines leave gaps
+    def iter_indexed_items(self) -> Iterable[Tuple[int, Dict[str, Any]]]:
         if self._csv is None:
             raise RuntimeError('Call enter before calling iter_items')
 
-        self._csv.seek(0)
+        self._rewind()
+        if self._engine == 'csv':
+            yield from self._iter_csv_items()
+            return
+
         self._cols_title = self._read_cols_title()
-        for line in self._csv:
+        for i, line in enumerate(self._csv):
             vals = self._parse_line(line)
             item = {k: v for k, v in zip(self._cols_title, vals)}
-            yield item
+            yield i, item
+
+    def _iter_csv_items(self) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        reader = csv.reader(self._csv, delimiter=self._sep)
+
+        self._cols_title = next(reader, None)
+        if self._cols_title is None:
+            return
+
+        title = self._cols_title
+        for row in reader:
+            if len(row) > 0:
+                yield reader.line_num - 2, dict(zip(title, row))
+
+    # shards are newline-aligned byte ranges, so every row must fit on one line.
+    # A compressed file can not be entered midway and is a single shard running
+    # to its end, so it is not decompressed just to count its lines.
+    def shards(self, n: int) -> List[InShard]:
+        assert n > 0
+
+        if self._compression is not None:
+            with open_compressed(self._filename, 'rb', buffering=self._buffer_size) as f:
+                f.readline()
+                if len(f.read(1)) == 0:
+                    return []
+            return [_CsvShard(0, None, 0, 0)]
+
+        with open(self._filename, 'rb') as f:
+            f.readline()
+            begin = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+
+            bounds = [begin]
+            for k in range(1, n):
+                pos = begin + (size - begin) * k // n
+                if pos <= bounds[-1]:
+                    continue
+                f.seek(pos - 1)
+                f.readline()
+                if bounds[-1] < f.tell() < size:
+                    bounds.append(f.tell())
+            bounds.append(size)
+
+            # rows are numbered across shards, so every shard's lines are
+            # counted here: one serial pass over the file, though a cheap one
+            # next to parsing it
+            shards, start = [], 0
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                if hi <= lo:
+                    continue
+                count = self._count_lines(f, lo, hi)
+                shards.append(_CsvShard(start, count, lo, hi))
+                start += count
+
+        return shards
+
+    def _count_lines(self, f: BinaryIO, lo: int, hi: int) -> int:
+        f.seek(lo)
+        count, left, last = 0, hi - lo, b''
+        while left > 0:
+            block = f.read(min(left, self._buffer_size))
+            if len(block) == 0:
+                break
+            count += block.count(b'\n')
+            left -= len(block)
+            last = block[-1:]
+        # the last line of a file may have no trailing newline
+        return count if last == b'\n' else count + 1
+
+    def iter_shard(self, shard: InShard) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        if self._csv is None:
+            raise RuntimeError('Call enter before calling iter_shard')
+        shard = typing.cast(_CsvShard, shard)
+
+        self._rewind()
+        if self._engine == 'csv':
+            title = next(csv.reader(self._csv, delimiter=self._sep))
+        else:
+            title = self._read_cols_title()
+        self._cols_title = title
+
+        if self._compression is not None:
+            yield from self._iter_shard_lines(shard, title, self._csv)
+            return
+
+        # decoded like the text-mode reader, so line endings come out the same
+        newline = '' if self._engine == 'csv' else None
+        with open(self._filename, 'rb', buffering=0) as f:
+            f.seek(shard.begin)
+            raw = io.BufferedReader(_ByteRange(f, shard.end - shard.begin), self._buffer_size)
+            with io.TextIOWrapper(raw, encoding=self._csv.encoding, newline=newline) as lines:
+                yield from self._iter_shard_lines(shard, title, lines)
+
+    def _iter_shard_lines(self,
+                          shard: InShard,
+                          title: List[str],
+                          lines: Iterable[str]) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        if self._engine == 'csv':
+            reader = csv.reader(lines, delimiter=self._sep)
+            for row in reader:
+                if len(row) > 0:
+                    yield shard.start + reader.line_num - 1, dict(zip(title, row))
+        else:
+            for i, line in enumerate(lines):
+                vals = self._parse_line(line)
+                yield shard.start + i, {k: v for k, v in zip(title, vals)}
 
     def close(self):
         if self._csv is None:
@@ -97,7 +365,35 @@ class CsvReadStream(InStream, Closer):
         self._csv = None
 
 
-class CsvWriteStream(OutStream, Closer, Flusher):
+class _CsvShard(InShard):
+    def __init__(self, start: int, count: Optional[int], begin: int, end: int):
+        super(_CsvShard, self).__init__(start, count)
+        self.begin = begin
+        self.end = end
+
+
+# Reads at most `nbytes` from the current position of a file, which is left open.
+class _ByteRange(io.RawIOBase):
+    def __init__(self, f: BinaryIO, nbytes: int):
+        self._f = f
+        self._left = nbytes
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._left <= 0:
+            return 0
+        with memoryview(b) as view:
+            n = self._f.readinto(view[:min(len(view), self._left)])
+        self._left -= n
+        return n
+
+
+class CsvWriteStream(OutStream, Resumable, Shardable, Closer, Flusher):
+    # max_buf_bytes, when set, flushes once that many bytes are buffered
+    # instead of after max_buf_size rows. Files ending in .gz, .bz2 or .xz
+    # are compressed in parallel blocks.
     def __init__(self,
                  filename: str,
                  cols: Sequence[str],
@@ -105,7 +401,8 @@ class CsvWriteStream(OutStream, Closer, Flusher):
                  sep: str = ',',
                  inc_id: Optional[str] = None,
                  max_buf_size: int = 20,
-                 multi_enter: bool = True):
+                 multi_enter: bool = True,
+                 max_buf_bytes: int = 0):
         # our name -> global name
         self._alias = alias if alias else {col: col for col in cols}
         self._requires = cols if alias is None else [alias.get(col, col) for col in cols]
@@ -118,9 +415,12 @@ class CsvWriteStream(OutStream, Closer, Flusher):
         self._line_no = -1
 
         self._buf = []
+        self._buf_bytes = 0
         self._max_buf_size = max_buf_size
+        self._max_buf_bytes = max_buf_bytes
         self._multi_enter = multi_enter
         self._entered = False
+        self._resumed = False
 
     def _open_csv(self, create: bool = True):
         self._csv = self._create_or_reopen_csv(self._filename, create)
@@ -130,7 +430,7 @@ class CsvWriteStream(OutStream, Closer, Flusher):
         folder, _ = os.path.split(filename)
         os.makedirs(folder, exist_ok=True)
         mode = 'w' if create else 'a'
-        return open(filename, mode)
+        return open_compressed(filename, mode)
 
     def _write_title(self):
         if self._inc_id is None:
@@ -144,7 +444,7 @@ class CsvWriteStream(OutStream, Closer, Flusher):
     def enter(self):
         assert self._csv is None
 
-        if self._multi_enter and self._entered:
+        if (self._multi_enter and self._entered) or self._resumed:
             self._open_csv(create=False)
         else:
             self._open_csv(create=True)
@@ -152,6 +452,7 @@ class CsvWriteStream(OutStream, Closer, Flusher):
             self._line_no = 0
 
         self._entered = True
+        self._resumed = False
 
         return self
 
@@ -170,11 +471,16 @@ class CsvWriteStream(OutStream, Closer, Flusher):
         if self._inc_id is not None:
             row.insert(0, str(self._line_no))
 
-        self._buf.append('{}\n'.format(self._sep.join(row)))
+        line = '{}\n'.format(self._sep.join(row))
+        self._buf.append(line)
+        self._buf_bytes += len(line)
         self._check_buf()
 
     def _check_buf(self):
-        if len(self._buf) > self._max_buf_size:
+        if self._max_buf_bytes > 0:
+            if self._buf_bytes >= self._max_buf_bytes:
+                self.flush()
+        elif len(self._buf) > self._max_buf_size:
             self.flush()
 
     @property
@@ -186,10 +492,52 @@ class CsvWriteStream(OutStream, Closer, Flusher):
             return
 
         if len(self._buf) > 0:
-            self._csv.writelines(self._buf)
+            self._csv.write(''.join(self._buf))
             self._buf = []
+            self._buf_bytes = 0
         self._csv.flush()
 
+    # out.csv -> out-00000.csv, out.csv.gz -> out-00000.csv.gz
+    def part(self, index: int) -> 'CsvWriteStream':
+        root, ext = _split_ext(self._filename)
+        return CsvWriteStream('{}-{:05d}{}'.format(root, index, ext), self._cols, self._alias, self._sep,
+                              self._inc_id, self._max_buf_size, self._multi_enter, self._max_buf_bytes)
+
+    # ids are numbered per part, so they are renumbered on the way
+    def merge(self, parts: Sequence['CsvWriteStream']):
+        with self:
+            self.flush()
+            for part in parts:
+                with open_compressed(part._filename) as f:
+                    f.readline()
+                    if self._inc_id is None:
+                        shutil.copyfileobj(f, self._csv, 1024 * 1024)
+                        continue
+                    for line in f:
+                        self._line_no += 1
+                        _, rest = line.split(self._sep, 1)
+                        line = '{}{}{}'.format(self._line_no, self._sep, rest)
+                        self._buf.append(line)
+                        self._buf_bytes += len(line)
+                        self._check_buf()
+                    self.flush()
+                os.remove(part._filename)
+
+    def checkpoint(self) -> Dict[str, int]:
+        if self._csv is None:
+            raise RuntimeError('Call enter before calling checkpoint')
+
+        self.flush()
+        return dict(offset=_sync(self._csv), line_no=self._line_no)
+
+    def resume(self, state: Dict[str, int]):
+        assert self._csv is None
+
+        with open(self._filename, 'r+b') as f:
+            f.truncate(state['offset'])
+        self._line_no = state['line_no']
+        self._resumed = True
+
     def close(self):
         if self._csv is None:
             return
@@ -197,3 +545,203 @@ class CsvWriteStream(OutStream, Closer, Flusher):
         self.flush()
         self._csv.close()
         self._csv = None
+
+
+# Binary record files: a magic line, then blocks prefixed with their byte size
+# and row count. The first block holds the column names, every other one a
+# pickled list of value tuples, so pickling is paid once per block.
+_RECORD_MAGIC = b'DFREC2\n'
+_BLOCK_HEAD = struct.Struct('<II')
+
+
+class RecordReadStream(InStream, Splittable, Closer):
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._file = None
+        self._mm = None
+        self._cols = None
+        self._begin = 0
+
+    def enter(self):
+        assert self._file is None
+        self._file = open(self._filename, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._cols, self._begin = self._read_cols(self._mm)
+        except ValueError:
+            self.close()
+            raise
+
+        return self
+
+    def exit(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_cols(self, mm: mmap.mmap) -> Tuple[List[str], int]:
+        if mm[:len(_RECORD_MAGIC)] != _RECORD_MAGIC:
+            raise ValueError('{} is not a record file'.format(self._filename))
+        return _read_block(mm, len(_RECORD_MAGIC))
+
+    def _iter_records(self, pos: int, end: int) -> Iterable[Dict[str, Any]]:
+        cols, mm = self._cols, self._mm
+        while pos < end:
+            rows, pos = _read_block(mm, pos)
+            for vals in rows:
+                yield dict(zip(cols, vals))
+
+    def iter_items(self) -> Iterable[Dict[str, Any]]:
+        if self._mm is None:
+            raise RuntimeError('Call enter before calling iter_items')
+
+        return self._iter_records(self._begin, len(self._mm))
+
+    # shards are made of whole blocks, found by reading the block heads only
+    def shards(self, n: int) -> List[InShard]:
+        assert n > 0
+
+        with open(self._filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            _, pos = self._read_cols(mm)
+            blocks, size, total = [], len(mm), 0
+            while pos < size:
+                nbytes, nrows = _BLOCK_HEAD.unpack_from(mm, pos)
+                blocks.append((pos, total))
+                pos += _BLOCK_HEAD.size + nbytes
+                total += nrows
+            blocks.append((size, total))
+
+        shards = []
+        for (lo, first), (hi, stop) in zip(blocks[:-1], blocks[1:]):
+            # blocks starting before the next shard's share of rows extend the last shard
+            if len(shards) > 0 and first < total * len(shards) // n:
+                shards[-1].count += stop - first
+                shards[-1].end = hi
+            else:
+                shards.append(_RecordShard(first, stop - first, lo, hi))
+
+        return shards
+
+    def iter_shard(self, shard: InShard) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        if self._mm is None:
+            raise RuntimeError('Call enter before calling iter_shard')
+        shard = typing.cast(_RecordShard, shard)
+
+        return enumerate(self._iter_records(shard.begin, shard.end), shard.start)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._mm.close()
+        self._file.close()
+        self._mm = None
+        self._file = None
+
+
+def _read_block(mm: mmap.mmap, pos: int) -> Tuple[Any, int]:
+    nbytes, _ = _BLOCK_HEAD.unpack_from(mm, pos)
+    pos += _BLOCK_HEAD.size
+    with memoryview(mm)[pos:pos + nbytes] as view:
+        return pickle.loads(view), pos + nbytes
+
+
+class _RecordShard(InShard):
+    def __init__(self, start: int, count: int, begin: int, end: int):
+        super(_RecordShard, self).__init__(start, count)
+        self.begin = begin
+        self.end = end
+
+
+class RecordWriteStream(OutStream, Resumable, Closer, Flusher):
+    def __init__(self,
+                 filename: str,
+                 cols: Sequence[str],
+                 alias: Mapping[str, str] = None,
+                 block_size: int = 1024,
+                 multi_enter: bool = True):
+        # our name -> global name
+        self._alias = alias if alias else {col: col for col in cols}
+        self._requires = cols if alias is None else [alias.get(col, col) for col in cols]
+        self._cols = cols
+
+        self._filename = filename
+        self._file = None
+
+        self._rows = []
+        self._block_size = block_size
+        self._multi_enter = multi_enter
+        self._entered = False
+        self._resumed = False
+
+    def enter(self):
+        assert self._file is None
+
+        if (self._multi_enter and self._entered) or self._resumed:
+            self._file = open(self._filename, 'ab')
+        else:
+            folder, _ = os.path.split(self._filename)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._file = open(self._filename, 'wb')
+            self._file.write(_RECORD_MAGIC)
+            self._write_block(list(self._cols), 0)
+
+        self._entered = True
+        self._resumed = False
+
+        return self
+
+    def exit(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_block(self, block: Any, nrows: int):
+        payload = pickle.dumps(block, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(_BLOCK_HEAD.pack(len(payload), nrows))
+        self._file.write(payload)
+
+    def put_item(self, item: Dict[str, Any]):
+        if self._file is None:
+            raise RuntimeError('Call enter before calling put_item')
+
+        alias = self._alias
+        self._rows.append(tuple(item[alias.get(col, col)] for col in self._cols))
+
+        if len(self._rows) >= self._block_size:
+            self._write_rows()
+
+    def _write_rows(self):
+        if len(self._rows) > 0:
+            self._write_block(self._rows, len(self._rows))
+            self._rows = []
+
+    @property
+    def requires(self) -> Sequence[str]:
+        return self._requires
+
+    def flush(self):
+        if self._file is None:
+            return
+
+        self._write_rows()
+        self._file.flush()
+
+    def checkpoint(self) -> Dict[str, int]:
+        if self._file is None:
+            raise RuntimeError('Call enter before calling checkpoint')
+
+        self.flush()
+        return dict(offset=self._file.tell())
+
+    def resume(self, state: Dict[str, int]):
+        assert self._file is None
+
+        with open(self._filename, 'r+b') as f:
+            f.truncate(state['offset'])
+        self._resumed = True
+
+    def close(self):
+        if self._file is None:
+            return
+
+        self.flush()
+        self._file.close()
+        self._file = None
@@ -0,0 +1,199 @@
+import os
+import uuid
+import queue
+import multiprocessing as mp
+
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, List, Tuple, Optional
+
+
+# Moves chunks of items between producer processes. The base transport leaves
+# items as they are, so they are pickled through the queues.
+class Transport(object):
+    def pack(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return items
+
+    def unpack(self, items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Any]]:
+        return items, []
+
+    def release(self, refs: List[Any]):
+        pass
+
+    def clear(self):
+        pass
+
+
+# Moves large bytes and numpy array values through shared memory segments, so
+# only a small reference travels through the queues. Arrays are unpacked as
+# views of the segment and stay valid until the chunk is released, after which
+# the segment is handed back for reuse. Segments are unlinked when a too small
+# free one is discarded and by `clear` once the producer has finished.
+class SharedMemoryTransport(Transport):
+    def __init__(self, min_size: int = 64 * 1024, max_attached: int = 256):
+        assert min_size > 0 and max_attached > 0
+        self._min_size = min_size
+        self._max_attached = max_attached
+        self._free = mp.Queue()
+
+        # segments are created and unlinked by different processes, which must
+        # therefore share the tracker started here instead of each forking one
+        resource_tracker.ensure_running()
+
+        self._pid = None
+        self._attached = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_attached'] = OrderedDict()
+        return state
+
+    def pack(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        packed = []
+        for item in items:
+            out = None
+            for k, v in item.items():
+                ref = self._put(v)
+                if ref is not None:
+                    if out is None:
+                        out = dict(item)
+                    out[k] = ref
+            packed.append(item if out is None else out)
+        return packed
+
+    def unpack(self, items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Any]]:
+        refs = []
+        for item in items:
+            for k, v in item.items():
+                if isinstance(v, _SharedRef):
+                    item[k] = self._get(v)
+                    refs.append(v)
+        return items, refs
+
+    def release(self, refs: List[Any]):
+        for ref in refs:
+            self._free.put((ref.name, ref.capacity))
+
+    def clear(self):
+        while True:
+            try:
+                name, _ = self._free.get_nowait()
+            except queue.Empty:
+                break
+            self._unlink(name)
+
+        for shm in self._segments().values():
+            _try_close(shm)
+        self._attached.clear()
+
+    def _put(self, val: Any) -> Optional['_SharedRef']:
+        if isinstance(val, (bytes, bytearray)):
+            if len(val) < self._min_size:
+                return None
+            shm = self._allocate(len(val))
+            shm.buf[:len(val)] = val
+            return _SharedRef(shm.name, shm.size, len(val))
+
+        if _is_ndarray(val) and val.nbytes >= self._min_size and not val.dtype.hasobject:
+            # noinspection PyPackageRequirements
+            import numpy as np
+
+            shm = self._allocate(val.nbytes)
+            dst = np.ndarray(val.shape, val.dtype, buffer=shm.buf)
+            dst[...] = val
+            del dst
+            return _SharedRef(shm.name, shm.size, val.nbytes, val.dtype, val.shape)
+
+        return None
+
+    def _get(self, ref: '_SharedRef') -> Any:
+        shm = self._attach(ref.name)
+
+        if ref.dtype is None:
+            with shm.buf[:ref.nbytes] as view:
+                return bytes(view)
+
+        # noinspection PyPackageRequirements
+        import numpy as np
+        return np.ndarray(ref.shape, ref.dtype, buffer=shm.buf)
+
+    def _allocate(self, nbytes: int) -> SharedMemory:
+        try:
+            name, capacity = self._free.get_nowait()
+        except queue.Empty:
+            name, capacity = None, 0
+
+        if name is not None:
+            if capacity >= nbytes:
+                return self._attach(name)
+            self._unlink(name)
+
+        shm = SharedMemory('df_{}'.format(uuid.uuid4().hex[:16]), create=True, size=nbytes)
+        self._remember(shm)
+        return shm
+
+    def _segments(self) -> 'OrderedDict[str, SharedMemory]':
+        # mappings are per process, an inherited cache belongs to the parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._attached = OrderedDict()
+        return self._attached
+
+    def _attach(self, name: str) -> SharedMemory:
+        segments = self._segments()
+
+        shm = segments.get(name, None)
+        if shm is None:
+            shm = SharedMemory(name)
+            self._remember(shm)
+        else:
+            segments.move_to_end(name)
+
+        return shm
+
+    def _remember(self, shm: SharedMemory):
+        segments = self._segments()
+        segments[shm.name] = shm
+
+        while len(segments) > self._max_attached:
+            name, oldest = next(iter(segments.items()))
+            del segments[name]
+            _try_close(oldest)
+
+    def _unlink(self, name: str):
+        shm = self._attach(name)
+        shm.unlink()
+        del self._segments()[name]
+        _try_close(shm)
+
+
+class _SharedRef(object):
+    __slots__ = ('name', 'capacity', 'nbytes', 'dtype', 'shape')
+
+    def __init__(self, name: str, capacity: int, nbytes: int, dtype: Any = None, shape: Any = None):
+        self.name = name
+        self.capacity = capacity
+        self.nbytes = nbytes
+        self.dtype = dtype
+        self.shape = shape
+
+    def __getstate__(self):
+        return self.name, self.capacity, self.nbytes, self.dtype, self.shape
+
+    def __setstate__(self, state):
+        self.name, self.capacity, self.nbytes, self.dtype, self.shape = state
+
+
+def _is_ndarray(val: Any) -> bool:
+    return type(val).__module__ == 'numpy' and type(val).__name__ == 'ndarray'
+
+
+def _try_close(shm: SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # views handed out from this segment are still alive; the mapping goes
+        # away with them
+        pass
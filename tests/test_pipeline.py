@@ -1,3 +1,6 @@
+import weakref
+import functools
+
 import dataflow as dflow
 
 
@@ -194,3 +197,464 @@ def test_complex_flow():
     pipe = dflow.SerialPipeline(flow)
 
     assert pipe.product(['l', 'm', 'n'], inputs) == (l, m, n)
+
+
+def test_compiled_route():
+    flow = dflow.DataFlow()
+    flow.const['k'] = 10
+
+    @flow.filter('a')
+    def filter_a(a):
+        return abs(a)
+
+    @flow.factory(requires=['a', 'b'], provides=['c', 'd'], require_const='k')
+    def compute_c_d(a, b, k):
+        return a + b, (a - b) * k
+
+    @flow.factory(requires=['c', 'd'], provides='e')
+    def compute_e(c, d):
+        return c * d
+
+    pipe = dflow.SerialPipeline(flow)
+
+    assert pipe.product(['e', 'c'], dict(a=-1, b=2)) == ((1 + 2) * (1 - 2) * 10, 3)
+
+    plan = pipe._get_plan({'c', 'e'}, {'a', 'b'})
+    assert pipe._get_plan({'e', 'c'}, {'b', 'a'}) is plan
+    assert len(pipe._cache_for_route) == 1
+
+    assert pipe.product('e', dict(a=3, b=1)) == 4 * 2 * 10
+    assert pipe._exec_chain(dict(a=3, b=1), plan.route)['e'] == 4 * 2 * 10
+
+
+
+def test_mutate_const():
+    import pickle
+
+    flow = dflow.DataFlow()
+    flow.const['k'] = 10
+
+    @flow.factory(requires='a', provides='b', require_const='k', memoize='lru')
+    def scale(a, k):
+        return a * k
+
+    pipe = dflow.SerialPipeline(flow)
+    assert pipe.product('b', dict(a=1)) == 10
+    flow.const['k'] = 100
+    assert pipe.product('b', dict(a=1)) == 100
+    flow.const.update(k=1000)
+    assert pipe.product('b', dict(a=1)) == 1000
+    assert pickle.loads(pickle.dumps(flow.const)) == {'k': 1000}
+
+
+def test_batch_pipeline():
+    flow = dflow.DataFlow()
+
+    @flow.filter('b', vectorized=True)
+    def filter_zero(b):
+        return [x if x else 1 for x in b]
+
+    @flow.factory(requires=['a', 'b'], provides='c', vectorized=True)
+    def div(a, b):
+        return [x / y for x, y in zip(a, b)]
+
+    @flow.factory(requires='c', provides=['d', 'e'])
+    def split(c):
+        return c + 1, c - 1
+
+    assert flow.operation(div).vectorized
+    assert not flow.operation(split).vectorized
+
+    pipe = dflow.BatchPipeline(flow)
+    items = [dict(a=4, b=2), dict(a=3, b=0), dict(a=1, b=4)]
+
+    assert pipe.product_batch('c', items) == [2, 3, 0.25]
+    assert pipe.product_batch(['d', 'e'], items) == [(3, 1), (4, 2), (1.25, -0.75)]
+    assert pipe.product('d', dict(a=4, b=2)) == 3
+    assert pipe.product_batch('c', []) == []
+
+    # the scalar pipelines call vectorized operations with one-row columns
+    for scalar in (dflow.SerialPipeline(flow), dflow.ThreadedDagPipeline(flow), dflow.AsyncPipeline(flow)):
+        assert [scalar.product(['d', 'e'], item) for item in items] == [(3, 1), (4, 2), (1.25, -0.75)]
+    assert dict(dflow.SerialPipeline(flow).product_lazy('c', items[1])) == dict(c=3)
+
+    serial = dflow.SerialPipeline(dflow.DataFlow())
+    assert serial.product_batch('a', [dict(a=1), dict(a=2)]) == [1, 2]
+
+
+def test_threaded_dag_pipeline():
+    import threading
+
+    flow = dflow.DataFlow()
+    # both branches must be running at the same time to pass the barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    @flow.filter('b')
+    def filter_zero(b):
+        return b if b else 1
+
+    @flow.factory(requires=['a', 'b'], provides='e')
+    def multiply(a, b):
+        barrier.wait()
+        return a * b
+
+    @flow.factory(requires=['c', 'b'], provides='f')
+    def division(c, b):
+        barrier.wait()
+        return c / b
+
+    @flow.factory(requires=['e', 'f'], provides='g')
+    def add(e, f):
+        return e + f
+
+    pipe = dflow.ThreadedDagPipeline(flow, max_workers=4)
+
+    assert pipe.product('g', dict(a=1, b=2, c=3)) == 2 + 1.5
+    assert pipe.product(['e', 'f', 'g'], dict(a=1, b=0, c=3)) == (1, 3, 4)
+
+    plan = pipe._get_plan({'g'}, {'a', 'b', 'c'})
+    levels = {op.fn.__name__: level for op, level in zip(plan.route, plan.levels)}
+    assert levels == dict(filter_zero=0, multiply=1, division=1, add=2)
+
+
+def test_memoized_factory():
+    flow = dflow.DataFlow()
+    flow.const['table'] = {'x': 1, 'y': 2}
+    calls = []
+
+    @flow.factory(requires='key', provides='val', require_const='table', memoize='lru')
+    def lookup(key, table):
+        calls.append(key)
+        return table[key[0]]
+
+    @flow.factory(requires='val', provides='out', memoize=dflow.LFUCache(max_entries=2))
+    def double(val):
+        return val * 2
+
+    pipe = dflow.SerialPipeline(flow)
+
+    for key in ['x', 'y', 'x', 'x', 'y']:
+        pipe.product('out', dict(key=key))
+    assert calls == ['x', 'y']
+    assert flow.operation(lookup).memoize.info() == dflow.CacheInfo(3, 2, 0, 2, 0)
+
+    # lists cannot be hashed, so they are computed every time
+    pipe.product('out', dict(key=['x']))
+    pipe.product('out', dict(key=['x']))
+    assert calls == ['x', 'y', ['x'], ['x']]
+    assert flow.operation(lookup).memoize.info().uncacheable == 2
+
+
+def test_memo_cache_eviction():
+    lru = dflow.LRUCache(max_entries=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    lru.get('a')
+    lru.put('c', 3)
+    assert list(lru._entries) == ['a', 'c']
+
+    lfu = dflow.LFUCache(max_entries=2)
+    lfu.put('a', 1)
+    lfu.get('a')
+    lfu.put('b', 2)
+    lfu.put('c', 3)
+    assert set(lfu._entries) == {'a', 'c'}
+
+    # new keys are still taken once every entry has been reused
+    lfu = dflow.LFUCache(max_entries=2)
+    for key in 'ab':
+        lfu.put(key, key)
+        lfu.get(key)
+    for key in 'cdefg':
+        lfu.put(key, key)
+        assert lfu.get(key) == key
+    assert len(lfu) == 2 and 'g' in lfu._entries
+
+    sized = dflow.LRUCache(max_bytes=200)
+    sized.put('a', b'x' * 100)
+    sized.put('b', b'y' * 100)
+    assert sized.info().entries == 1 and sized.info().nbytes <= 200
+
+
+DISK_CALLS = []
+
+
+def test_disk_cache(tmp_path):
+    def build_flow(scale):
+        flow = dflow.DataFlow()
+        flow.const['scale'] = scale
+
+        @flow.factory(requires='a', provides='b', require_const='scale')
+        def expensive(a, scale):
+            DISK_CALLS.append(('expensive', a))
+            return a * scale
+
+        @flow.factory(requires='b', provides='c')
+        def cheap(b):
+            DISK_CALLS.append(('cheap', b))
+            return b + 1
+
+        return flow
+
+    del DISK_CALLS[:]
+    cache = dflow.DiskCache(str(tmp_path / 'cache'))
+    assert dflow.SerialPipeline(build_flow(2), disk_cache=cache).product('c', dict(a=3)) == 7
+    assert len(DISK_CALLS) == 2
+
+    # a fresh pipeline and cache object over the same directory, as in a rerun
+    cache = dflow.DiskCache(str(tmp_path / 'cache'))
+    assert dflow.SerialPipeline(build_flow(2), disk_cache=cache).product('c', dict(a=3)) == 7
+    assert len(DISK_CALLS) == 2
+    assert cache.info().hits == 2 and cache.info().entries == 2
+
+    # a changed const only invalidates the operation that uses it
+    assert dflow.SerialPipeline(build_flow(3), disk_cache=cache).product('c', dict(a=3)) == 10
+    assert DISK_CALLS[2:] == [('expensive', 3), ('cheap', 9)]
+
+    small = dflow.DiskCache(str(tmp_path / 'small'), max_bytes=200)
+    pipe = dflow.SerialPipeline(build_flow(1), disk_cache=small)
+    for a in range(20):
+        pipe.product('c', dict(a=a))
+    assert small.info().nbytes <= 200
+
+
+FINGERPRINT_SCRIPT = """
+import dataflow.cache as cache
+
+def tagged(a, tags=frozenset(['red', 'green', 'blue', 'cyan'])):
+    return a in {'ant', 'bee', 'cat', 'dog', 'eel'} and a in tags
+
+print(cache._fingerprint(tagged, ({'x', 'y', 'z', 'w'},)).hex())
+print(cache._encode(({'p', 'q', 'r', 's'}, [frozenset({'k', 'l', 'm'})])).hex())
+"""
+
+
+def test_fingerprint_hash_seed():
+    import os
+    import sys
+    import subprocess
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    outs = []
+    for seed in ('1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=root)
+        outs.append(subprocess.run([sys.executable, '-c', FINGERPRINT_SCRIPT], env=env,
+                                   capture_output=True, text=True, check=True).stdout)
+    assert outs[0] == outs[1]
+
+
+def test_lazy_product():
+    flow = dflow.DataFlow()
+    calls = []
+
+    @flow.filter('a')
+    def filter_a(a):
+        calls.append('filter_a')
+        return a * 10
+
+    @flow.factory(requires='a', provides=['b', 'c'])
+    def compute_b_c(a):
+        calls.append('compute_b_c')
+        return a + 1, a + 2
+
+    @flow.factory(requires='b', provides='d')
+    def compute_d(b):
+        calls.append('compute_d')
+        return b * 2
+
+    @flow.factory(requires='x', provides='e')
+    def compute_e(x):
+        calls.append('compute_e')
+        return -x
+
+    pipe = dflow.SerialPipeline(flow)
+    result = pipe.product_lazy(['c', 'd', 'e'], dict(a=1, x=5))
+
+    assert calls == [] and list(result) == ['c', 'd', 'e']
+    assert 'e' in result and 'b' not in result and calls == []
+    assert result['c'] == 12
+    assert calls == ['filter_a', 'compute_b_c']
+    assert result['d'] == 22 and result['c'] == 12
+    assert calls == ['filter_a', 'compute_b_c', 'compute_d']
+    assert not result.is_computed('e')
+    assert dict(result) == dict(c=12, d=22, e=-5)
+    assert calls == ['filter_a', 'compute_b_c', 'compute_d', 'compute_e']
+
+
+class Blob(object):
+    pass
+
+
+def test_liveness():
+    flow = dflow.DataFlow()
+    refs = {}
+
+    @flow.factory(requires='a', provides='x')
+    def decode(a):
+        refs['x'] = weakref.ref(Blob())
+        return refs['x']()
+
+    @flow.factory(requires='x', provides=['y', 'unused'])
+    def resize(x):
+        refs['unused'] = weakref.ref(Blob())
+        return Blob(), refs['unused']()
+
+    @flow.factory(requires='y', provides='z')
+    def features(y):
+        # x and unused have no consumers left by now
+        return refs['x']() is None and refs['unused']() is None
+
+    for pipe in (dflow.SerialPipeline(flow), dflow.BatchPipeline(flow),
+                 dflow.ThreadedDagPipeline(flow, max_workers=2)):
+        assert pipe.product(['z', 'y'], dict(a=1))[0] is True
+
+
+def build_wide_flow():
+    flow = dflow.DataFlow()
+
+    @flow.filter('a')
+    def filter_a(a):
+        return a + 1
+
+    @flow.filter(['b', 'c'])
+    def filter_b_c(b, c):
+        return b * 2, c * 2
+
+    @flow.factory(requires=['a', 'b'], provides=['d', 'e'])
+    def compute_d_e(a, b):
+        return a + b, a - b
+
+    @flow.factory(requires=['d', 'c'], provides='f')
+    def compute_f(d, c):
+        return d * c
+
+    @flow.factory(requires=['e', 'f'], provides='g')
+    def compute_g(e, f):
+        return e + f
+
+    return flow
+
+
+def test_frozen_flow():
+    inputs = [dict(a=1, b=2, c=3), dict(a=1, b=2, c=3, d=7), dict(c=3, e=4, f=5), dict(g=1)]
+    targets = [('g',), ('f', 'e'), ('g', 'e'), ('d',)]
+
+    expected = {}
+    pipe = dflow.SerialPipeline(build_wide_flow())
+    for item in inputs:
+        for target in targets:
+            try:
+                expected[tuple(item), target] = pipe.product(target, item)
+            except TypeError:
+                expected[tuple(item), target] = TypeError
+
+    flow = build_wide_flow().freeze()
+    assert flow.frozen and flow.freeze() is flow
+    assert flow.index.upstream('f') == {'a', 'b', 'c', 'd'}
+    assert {op.fn.__name__ for op in flow.index.closure('g')} == {'compute_d_e', 'compute_f', 'compute_g'}
+
+    pipe = dflow.SerialPipeline(flow)
+    for item in inputs:
+        for target in targets:
+            try:
+                assert pipe.product(target, item) == expected[tuple(item), target]
+            except TypeError:
+                assert expected[tuple(item), target] is TypeError
+
+    init, route = pipe._get_route({'g'}, {'a', 'b', 'c'})
+    assert init == {'a', 'b', 'c'}
+    assert [op.fn.__name__ for op in route] == ['filter_a', 'filter_b_c', 'compute_d_e', 'compute_f', 'compute_g']
+
+    try:
+        flow.append_filter('g', abs)
+        assert False
+    except RuntimeError:
+        pass
+
+    pipe._ROUTE_CACHE_SIZE = 2
+    pipe.product('g', inputs[0])
+    pipe.product('e', inputs[0])
+    assert len(pipe._cache_for_route) == 2
+    assert pipe._get_plan({'g'}, {'c', 'b', 'a'}) is pipe._get_plan({'g'}, inputs[0].keys())
+
+
+def test_frozen_circle_flow():
+    flow = dflow.DataFlow()
+    flow.append_factory('a', 'b', abs)
+    flow.append_factory('b', 'a', abs)
+
+    try:
+        flow.freeze()
+        assert False
+    except dflow.CircularDependence:
+        assert not flow.frozen
+
+
+def test_operation_hooks():
+    flow = dflow.DataFlow()
+
+    @flow.filter('a')
+    def check_a(a):
+        if a < 0:
+            raise ValueError(a)
+        return a
+
+    @flow.factory(requires='a', provides='b')
+    def double(a):
+        return a * 2
+
+    pipe = dflow.SerialPipeline(flow)
+    assert pipe.product('b', dict(a=1)) == 2
+
+    events = []
+    pipe.add_hook(pre=lambda op: events.append(('pre', op.fn.__name__)),
+                  post=lambda op, elapsed, exc: events.append(('post', op.fn.__name__, exc is None)))
+    profiler = pipe.enable_profiling()
+
+    assert pipe.product('b', dict(a=1)) == 2
+    assert events == [('pre', 'check_a'), ('post', 'check_a', True), ('pre', 'double'), ('post', 'double', True)]
+
+    try:
+        pipe.product('b', dict(a=-1))
+        assert False
+    except ValueError:
+        pass
+
+    stats = profiler.stats
+    assert stats['test_pipeline.test_operation_hooks.<locals>.check_a -> a'].count == 2
+    assert stats['test_pipeline.test_operation_hooks.<locals>.check_a -> a'].errors == 1
+    assert stats['test_pipeline.test_operation_hooks.<locals>.double -> b'].count == 1
+    d = stats['test_pipeline.test_operation_hooks.<locals>.double -> b']
+    assert d.min <= d.percentile(50) <= d.percentile(99) <= d.max <= d.total
+    assert 'double' in profiler.report()
+
+    pipe.clear_hooks()
+    assert pipe.profiler is None
+    pipe.product('b', dict(a=1))
+    assert len(events) == 6 and profiler.stats['test_pipeline.test_operation_hooks.<locals>.double -> b'].count == 1
+
+    # operations sharing a lambda, partial or builtin get stats of their own
+    flow = dflow.DataFlow()
+    flow.append_factory('a', 'b', lambda a: a + 1)
+    flow.append_factory('b', 'c', lambda b: b * 2)
+    flow.append_factory('c', 'd', functools.partial(max, 0))
+    flow.append_factory('d', 'e', functools.partial(max, 1))
+    flow.append_factory('e', 'f', abs)
+    pipe = dflow.SerialPipeline(flow)
+    profiler = pipe.enable_profiling()
+    assert pipe.product('f', dict(a=1)) == 4
+    assert sorted(profiler.stats) == ['builtins.abs -> f', 'builtins.max -> d', 'builtins.max -> e',
+                                      'test_pipeline.test_operation_hooks.<locals>.<lambda> -> b',
+                                      'test_pipeline.test_operation_hooks.<locals>.<lambda> -> c']
+
+
+def test_op_stats_merge():
+    a, b = dflow.OpStats(), dflow.OpStats()
+    for i in range(1, 101):
+        (a if i % 2 else b).record(i / 1000)
+    a.merge(b)
+
+    assert a.count == 100 and abs(a.total - 5.05) < 1e-9
+    assert abs(a.percentile(50) - 0.05) < 0.05 * 0.05
+    assert abs(a.percentile(90) - 0.09) < 0.09 * 0.05
+    assert a.percentile(100) == a.max == 0.1
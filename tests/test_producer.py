@@ -0,0 +1,614 @@
+import time
+import asyncio
+import multiprocessing as mp
+
+import dataflow as dflow
+
+
+class ListInStream(dflow.InStream):
+    def __init__(self, items):
+        self.items = items
+
+    def iter_items(self):
+        return iter(self.items)
+
+
+class ListOutStream(dflow.OutStream):
+    def __init__(self, cols):
+        self.cols = cols
+        self.items = []
+
+    def put_item(self, item):
+        self.items.append(item)
+
+    @property
+    def requires(self):
+        return self.cols
+
+
+def build_async_flow():
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires='a', provides='b')
+    async def slow_double(a):
+        await asyncio.sleep(0.01 * (a % 3))
+        return a * 2
+
+    @flow.factory(requires='a', provides='c')
+    def square(a):
+        return a * a
+
+    @flow.factory(requires=['b', 'c'], provides='d')
+    async def add(b, c):
+        return b + c
+
+    return flow
+
+
+def test_async_pipeline():
+    pipe = dflow.AsyncPipeline(build_async_flow())
+
+    assert pipe.product('d', dict(a=3)) == 6 + 9
+    assert asyncio.run(pipe.aproduct(['b', 'c'], dict(a=2))) == (4, 4)
+
+
+def test_async_producer():
+    items = [dict(a=i) for i in range(20)]
+    expected = [dict(a=i, d=2 * i + i * i) for i in range(20)]
+
+    ous = ListOutStream(['a', 'd'])
+    dflow.AsyncProducer(max_in_flight=4).produce(build_async_flow(), ListInStream(items), ous,
+                                                 keep_order=True)
+    assert ous.items == expected
+
+    ous = ListOutStream(['a', 'd'])
+    dflow.AsyncProducer().produce(build_async_flow(), ListInStream(items), ous)
+    assert sorted(ous.items, key=lambda item: item['a']) == expected
+
+
+
+class FailingOutStream(ListOutStream):
+    def put_item(self, item):
+        raise IOError('disk full')
+
+
+def test_async_producer_sink_error():
+    import pytest
+
+    for n, keep_order in [(3, False), (100, False), (100, True)]:
+        items = [dict(a=i) for i in range(n)]
+        with pytest.raises(IOError):
+            dflow.AsyncProducer(max_in_flight=4).produce(build_async_flow(), ListInStream(items),
+                                                         FailingOutStream(['a', 'd']),
+                                                         keep_order=keep_order)
+
+
+def build_csv_flow():
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires=['a', 'b'], provides='c')
+    def add(a, b):
+        return int(a) + int(b)
+
+    return flow
+
+
+def write_input_csv(filename, n):
+    with open(filename, 'w') as f:
+        f.write('a,b\n')
+        for i in range(n):
+            f.write('{},{}\n'.format(i, i * 10))
+
+
+def read_output_csv(filename):
+    with open(filename) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def test_parallel_producer_chunks(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 500
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    expected = ['a,c'] + ['{},{}'.format(i, i * 11) for i in range(n)]
+
+    for chunk_size in (0, 1, 7):
+        producer = dflow.ParallelProducer(num_workers=3, chunk_size=chunk_size)
+        out = str(tmp_path / 'out-{}.csv'.format(chunk_size))
+        producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                         CsvWriteStream(out, ['a', 'c']), keep_order=True)
+        assert read_output_csv(out) == expected
+
+    out = str(tmp_path / 'out-unordered.csv')
+    dflow.ParallelProducer(num_workers=3, chunk_size=16).produce(
+        build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')), CsvWriteStream(out, ['a', 'c']))
+    lines = read_output_csv(out)
+    assert lines[0] == 'a,c' and sorted(lines[1:]) == sorted(expected[1:])
+
+
+def test_parallel_producer_backpressure(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 300
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    expected = ['a,c'] + ['{},{}'.format(i, i * 11) for i in range(n)]
+
+    for chunk_size in (0, 4, 32):
+        producer = dflow.ParallelProducer(num_workers=3, chunk_size=chunk_size,
+                                          max_queue_size=1, reorder_window=8)
+        out = str(tmp_path / 'out-{}.csv'.format(chunk_size))
+        producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                         CsvWriteStream(out, ['a', 'c']), keep_order=True)
+        assert read_output_csv(out) == expected
+
+
+class BlobInStream(dflow.InStream):
+    def __init__(self, n, size):
+        self.n = n
+        self.size = size
+
+    def iter_items(self):
+        for i in range(self.n):
+            yield dict(i=i, blob=bytes([i % 256]) * self.size)
+
+
+def test_shared_memory_transport(tmp_path):
+    import os
+    from dataflow.stream import CsvWriteStream
+
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires=['i', 'blob'], provides='check')
+    def check(i, blob):
+        assert blob == bytes([i % 256]) * len(blob)
+        return len(blob)
+
+    @flow.factory(requires='blob', provides='head')
+    def head(blob):
+        return blob[:2].hex()
+
+    transport = dflow.SharedMemoryTransport(min_size=1024)
+    producer = dflow.ParallelProducer(num_workers=2, chunk_size=4, transport=transport)
+    out = str(tmp_path / 'out.csv')
+    producer.produce(flow, BlobInStream(200, 4096), CsvWriteStream(out, ['i', 'check', 'head']),
+                     keep_order=True)
+
+    expected = ['i,check,head'] + ['{},4096,{}'.format(i, bytes([i % 256] * 2).hex()) for i in range(200)]
+    assert read_output_csv(out) == expected
+    assert not any(name.startswith('df_') for name in os.listdir('/dev/shm'))
+
+    items = transport.pack([dict(a=b'x' * 2048, b=b'small', c=1)])
+    assert type(items[0]['a']).__name__ == '_SharedRef' and items[0]['b'] == b'small'
+    items, refs = transport.unpack(items)
+    assert items == [dict(a=b'x' * 2048, b=b'small', c=1)] and len(refs) == 1
+    transport.release(refs)
+    transport.clear()
+
+
+
+class ArrayInStream(dflow.InStream):
+    def __init__(self, n, size):
+        self.n = n
+        self.size = size
+
+    def iter_items(self):
+        import numpy as np
+        for i in range(self.n):
+            yield dict(i=i, arr=np.full(self.size, i, dtype='float64'))
+
+
+def test_shared_memory_transport_arrays(tmp_path):
+    import pytest
+    np = pytest.importorskip('numpy')
+    from dataflow.stream import RecordReadStream, RecordWriteStream
+
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires='arr', provides='double')
+    def double(arr):
+        return arr * 2
+
+    # a small slice stays a view of the input segment through the out queue
+    @flow.factory(requires='arr', provides='head')
+    def head(arr):
+        return arr[:4]
+
+    transport = dflow.SharedMemoryTransport(min_size=1024)
+    producer = dflow.ParallelProducer(num_workers=2, chunk_size=4, transport=transport)
+    out = str(tmp_path / 'out.rec')
+    # the sink buffers rows, which must not change once their segments are reused
+    producer.produce(flow, ArrayInStream(200, 20000),
+                     RecordWriteStream(out, ['i', 'arr', 'double', 'head'], block_size=64),
+                     keep_order=True)
+
+    with RecordReadStream(out) as ins:
+        items = list(ins.iter_items())
+    assert [item['i'] for item in items] == list(range(200))
+    for item in items:
+        i = item['i']
+        assert np.all(item['arr'] == i) and np.all(item['double'] == 2 * i) and np.all(item['head'] == i)
+
+
+def test_parallel_producer_split_input(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 400
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    with open(str(tmp_path / 'in.csv'), 'a') as f:
+        # a blank line and a last row without trailing newline
+        f.write('\n{},{}'.format(n, n * 10))
+    expected = ['a,c'] + ['{},{}'.format(i, i * 11) for i in range(n + 1)]
+
+    for chunk_size, window in ((0, 0), (3, 5)):
+        producer = dflow.ParallelProducer(num_workers=3, chunk_size=chunk_size,
+                                          reorder_window=window, split_input=True)
+        out = str(tmp_path / 'out-{}.csv'.format(chunk_size))
+        producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv'), engine='csv'),
+                         CsvWriteStream(out, ['a', 'c']), keep_order=True)
+        assert read_output_csv(out) == expected
+
+    # a compressed input is one shard with no known length
+    from dataflow.compression import open_compressed
+    with open(str(tmp_path / 'in.csv')) as f, open_compressed(str(tmp_path / 'in.csv.gz'), 'w') as gz:
+        gz.write(f.read())
+    producer = dflow.ParallelProducer(num_workers=3, chunk_size=3, split_input=True)
+    out = str(tmp_path / 'out-gz.csv')
+    producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv.gz'), engine='csv'),
+                     CsvWriteStream(out, ['a', 'c']), keep_order=True)
+    assert read_output_csv(out) == expected
+
+
+def build_logging_flow(log):
+    flow = dflow.DataFlow()
+    flow.const['log'] = log
+
+    @flow.factory(requires=['a', 'b'], provides='c', require_const='log')
+    def add(a, b, log):
+        with open(log, 'a') as f:
+            f.write('{}\n'.format(a))
+        return int(a) + int(b)
+
+    return flow
+
+
+def test_parallel_producer_checkpoint(tmp_path):
+    import json
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 300
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    out, ckpt, log = str(tmp_path / 'out.csv'), str(tmp_path / 'out.ckpt'), str(tmp_path / 'log')
+    expected = ['id,a,c'] + ['{},{},{}'.format(i + 1, i, i * 11) for i in range(n)]
+
+    producer = dflow.ParallelProducer(num_workers=3, chunk_size=8)
+    producer.produce(build_logging_flow(log), CsvReadStream(str(tmp_path / 'in.csv')),
+                     CsvWriteStream(out, ['a', 'c'], inc_id='id'), keep_order=True,
+                     checkpoint=ckpt, checkpoint_interval=0)
+    assert read_output_csv(out) == expected
+    assert json.load(open(ckpt))['watermark'] == n
+
+    # pretend the run died after 120 rows, with a torn row written after the checkpoint
+    offset = sum(len(line) + 1 for line in expected[:121])
+    with open(ckpt, 'w') as f:
+        json.dump(dict(watermark=120, done=[], ous=dict(offset=offset, line_no=120)), f)
+    with open(out, 'a') as f:
+        f.write('999,torn')
+    open(log, 'w').close()
+
+    for split_input in (False, True):
+        producer = dflow.ParallelProducer(num_workers=3, chunk_size=8, split_input=split_input)
+        producer.produce(build_logging_flow(log), CsvReadStream(str(tmp_path / 'in.csv')),
+                         CsvWriteStream(out, ['a', 'c'], inc_id='id'), keep_order=True,
+                         checkpoint=ckpt, resume=True)
+        assert read_output_csv(out) == expected
+        with open(ckpt, 'w') as f:
+            json.dump(dict(watermark=120, done=[], ous=dict(offset=offset, line_no=120)), f)
+
+    with open(log) as f:
+        assert sorted(int(line) for line in f) == sorted(list(range(120, n)) * 2)
+
+
+def test_done_indices():
+    from dataflow.producer import _DoneIndices
+
+    done = _DoneIndices()
+    done.add(10, 5)
+    done.add(0, 4)
+    done.add(20, 5)
+    assert done.watermark == 4 and done.ranges() == [[10, 15], [20, 25]]
+    done.add(15, 5)
+    assert done.ranges() == [[10, 25]]
+    assert done.covers(12, 20) and not done.covers(3, 12)
+
+    items = [(i, i) for i in range(30)]
+    assert [i for i, _ in done.skip(items)] == list(range(4, 10)) + list(range(25, 30))
+    done.add(4, 6)
+    assert done.watermark == 25 and done.ranges() == []
+
+    # chunks of a resumed run span the ranges it started with
+    done = _DoneIndices(0, [[8, 10]])
+    done.add(0, 4)
+    assert done.watermark == 4 and done.ranges() == [[8, 10]]
+    done.add(6, 6)
+    assert done.ranges() == [[6, 12]]
+    done.add(4, 2)
+    assert done.watermark == 12 and done.ranges() == []
+
+
+class FailingInStream(ListInStream):
+    def __init__(self, items, fail_at=None):
+        super(FailingInStream, self).__init__(items)
+        self.fail_at = fail_at
+
+    def iter_items(self):
+        for i, item in enumerate(self.items):
+            if i == self.fail_at:
+                raise RuntimeError('input failed at {}'.format(i))
+            yield item
+
+
+def test_parallel_producer_resume_twice(tmp_path):
+    import json
+    from dataflow.stream import CsvWriteStream
+
+    n = 100
+    items = [dict(a=str(i), b=str(i * 10)) for i in range(n)]
+    expected = ['{},{}'.format(i, i * 11) for i in range(n)]
+    out, ckpt = str(tmp_path / 'out.csv'), str(tmp_path / 'out.ckpt')
+
+    # an unordered run died with rows 40..79 written ahead of the watermark
+    with open(out, 'w') as f:
+        f.write('a,c\n' + ''.join(line + '\n' for line in expected[40:80]))
+        offset = f.tell()
+    with open(ckpt, 'w') as f:
+        json.dump(dict(watermark=0, done=[[40, 80]], ous=dict(offset=offset, line_no=40)), f)
+
+    # the first resume dies again before reaching them, the second finishes
+    for fail_at in (20, None):
+        producer = dflow.ParallelProducer(num_workers=2, chunk_size=4)
+        producer.produce(build_csv_flow(), FailingInStream(items, fail_at), CsvWriteStream(out, ['a', 'c']),
+                         checkpoint=ckpt, checkpoint_interval=0, resume=True)
+        with open(ckpt) as f:
+            assert [40, 80] in json.load(f)['done'] or fail_at is None
+
+    lines = read_output_csv(out)
+    assert lines[0] == 'a,c' and sorted(lines[1:]) == sorted(expected)
+
+
+def test_parallel_producer_profile(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 200
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+
+    for split_input in (False, True):
+        producer = dflow.ParallelProducer(num_workers=3, chunk_size=8, split_input=split_input, profile=True)
+        producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                         CsvWriteStream(str(tmp_path / 'out.csv'), ['a', 'c']))
+        stats = producer.profiler.stats
+        assert list(stats) == ['test_producer.build_csv_flow.<locals>.add -> c']
+        assert stats['test_producer.build_csv_flow.<locals>.add -> c'].count == n
+
+
+
+def test_parallel_producer_profile_failure(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    write_input_csv(str(tmp_path / 'in.csv'), 100)
+
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires='a', provides='c')
+    def fail_at_7(a):
+        if a == '7':
+            raise ValueError('bad item')
+        return a
+
+    # the worker dying on the bad item still sends its stats
+    for split_input in (False, True):
+        producer = dflow.ParallelProducer(num_workers=2, chunk_size=4, split_input=split_input, profile=True)
+        producer.produce(flow, CsvReadStream(str(tmp_path / 'in.csv'), engine='csv'),
+                         CsvWriteStream(str(tmp_path / 'out.csv'), ['c']))
+        assert list(producer.profiler.stats) == ['test_producer.test_parallel_producer_profile_failure.'
+                                                 '<locals>.fail_at_7 -> c']
+
+
+def test_parallel_producer_metrics(tmp_path):
+    import json
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 300
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+
+    samples = []
+    producer = dflow.ParallelProducer(num_workers=3, chunk_size=8)
+    producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                     CsvWriteStream(str(tmp_path / 'out.csv'), ['a', 'c']), keep_order=True,
+                     metrics=samples.append, metrics_interval=0.01)
+
+    final = samples[-1]
+    assert final['final'] and all(not sample['final'] for sample in samples[:-1])
+    assert final['rows_read'] == n and final['rows_written'] == n
+    assert final['reorder_buffer'] == 0
+    assert len(final['worker_busy']) == len(final['worker_idle']) == 3
+    assert sum(final['worker_busy']) > 0 and final['writer_stall'] > 0
+
+    metrics = str(tmp_path / 'metrics.jsonl')
+    producer = dflow.ParallelProducer(num_workers=2, chunk_size=8, split_input=True)
+    producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                     CsvWriteStream(str(tmp_path / 'out.csv'), ['a', 'c']),
+                     metrics=metrics, metrics_interval=0.01)
+    with open(metrics) as f:
+        samples = [json.loads(line) for line in f]
+    assert samples[-1]['final'] and samples[-1]['rows_read'] == samples[-1]['rows_written'] == n
+
+
+def test_autoscaler():
+    from dataflow.producer import _Autoscaler
+
+    scaler = _Autoscaler(1, 4)
+    # busy workers with a backlog get help while the rate keeps growing
+    assert scaler.decide(1, 10, False, 0.95, 100.0) == 2
+    assert scaler.decide(2, 10, False, 0.95, 190.0) == 3
+    # the third worker did not pay off: back to two and no new probes for a while
+    assert scaler.decide(3, 10, False, 0.95, 192.0) == 2
+    assert scaler.decide(2, 10, False, 0.95, 190.0) == 2
+    # no backlog or a full writer queue holds, idle workers are retired
+    scaler = _Autoscaler(1, 4)
+    assert scaler.decide(2, 0, False, 0.95, 100.0) == 2
+    assert scaler.decide(2, 10, True, 0.95, 100.0) == 2
+    assert scaler.decide(2, 0, False, 0.1, 100.0) == 1
+    assert scaler.decide(1, 0, False, 0.1, 100.0) == 1
+
+
+def build_sleepy_flow():
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires=['a', 'b'], provides='c')
+    def add(a, b):
+        time.sleep(0.002)
+        return int(a) + int(b)
+
+    return flow
+
+
+def test_parallel_producer_autoscale(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 1500
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    expected = ['a,c'] + ['{},{}'.format(i, i * 11) for i in range(n)]
+
+    samples = []
+    producer = dflow.ParallelProducer(chunk_size=4, min_workers=1, max_workers=6)
+    producer._SCALE_INTERVAL = 0.05
+    out = str(tmp_path / 'out.csv')
+    producer.produce(build_sleepy_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                     CsvWriteStream(out, ['a', 'c']), keep_order=True,
+                     metrics=samples.append, metrics_interval=0.05)
+
+    assert read_output_csv(out) == expected
+    # the rows wait on sleep, so more workers than the single start one pay off
+    assert samples[0]['workers'] >= 1 and max(sample['workers'] for sample in samples) > 1
+
+
+def test_parallel_producer_iter_results(tmp_path):
+    from dataflow.stream import CsvReadStream
+
+    n = 400
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    expected = [dict(a=str(i), c=i * 11) for i in range(n)]
+
+    producer = dflow.ParallelProducer(num_workers=3, chunk_size=7)
+    results = producer.iter_results(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                                    ['a', 'c'], keep_order=True, prefetch=20)
+    assert list(results) == expected
+
+    producer = dflow.ParallelProducer(num_workers=2, split_input=True)
+    results = producer.iter_results(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')), ['a', 'c'])
+    assert sorted(results, key=lambda item: int(item['a'])) == expected
+
+    # leaving early stops the reader and lets the workers run dry
+    producer = dflow.ParallelProducer(num_workers=2, chunk_size=4, max_queue_size=2)
+    results = producer.iter_results(build_sleepy_flow(), CsvReadStream(str(tmp_path / 'in.csv')), 'c',
+                                    keep_order=True)
+    consumed = []
+    for item in results:
+        consumed.append(item)
+        if len(consumed) == 11:
+            break
+    results.close()
+    assert consumed == [dict(c=i * 11) for i in range(11)]
+    assert mp.active_children() == []
+
+
+def test_parallel_producer_persistent():
+    frozen = build_csv_flow().freeze()
+    items = [dict(a=str(i), b=str(i * 10)) for i in range(100)]
+    expected = [dict(a=str(i), c=i * 11) for i in range(100)]
+
+    with dflow.ParallelProducer(num_workers=2, chunk_size=8, persistent=True) as producer:
+        pids = []
+        for flow in (frozen, frozen, frozen, build_csv_flow()):
+            ous = ListOutStream(['a', 'c'])
+            producer.produce(flow, ListInStream(items), ous, keep_order=True)
+            assert ous.items == expected
+            pids.append(sorted(p.pid for p in mp.active_children()))
+
+        # the same workers serve every run of the frozen flow
+        assert len(pids[0]) == 2 and pids[0] == pids[1] == pids[2] != pids[3]
+
+        # an abandoned run leaves nothing behind for the next one
+        for i, item in enumerate(producer.iter_results(frozen, ListInStream(items), 'c', keep_order=True)):
+            if i == 10:
+                break
+        ous = ListOutStream(['a', 'c'])
+        producer.produce(frozen, ListInStream(items), ous)
+        assert sorted(ous.items, key=lambda item: int(item['a'])) == expected
+
+    assert mp.active_children() == []
+
+
+def test_fan_out(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 200
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    summary, detail = str(tmp_path / 'summary.csv'), str(tmp_path / 'detail.csv')
+    sinks = [CsvWriteStream(summary, ['c']), CsvWriteStream(detail, ['a', 'b', 'c'])]
+    dflow.ParallelProducer(num_workers=2, chunk_size=16).produce(
+        build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')), sinks, keep_order=True,
+        checkpoint=str(tmp_path / 'ckpt.json'))
+    assert read_output_csv(summary) == ['c'] + [str(i * 11) for i in range(n)]
+    assert read_output_csv(detail) == ['a,b,c'] + ['{},{},{}'.format(i, i * 10, i * 11) for i in range(n)]
+
+    # shared factories run once per item, whatever the number of sinks
+    calls = []
+    flow = dflow.DataFlow()
+
+    @flow.factory(requires='a', provides='b')
+    def double(a):
+        calls.append(a)
+        return a * 2
+
+    @flow.factory(requires='b', provides='c')
+    def inc(b):
+        return b + 1
+
+    items = [dict(a=i) for i in range(20)]
+    sinks = [ListOutStream(['b']), ListOutStream(['a', 'c'])]
+    fanned = dflow.fan_out(sinks)
+    assert fanned.requires == ['b', 'a', 'c'] and not isinstance(fanned, dflow.Resumable)
+
+    dflow.AsyncProducer().produce(flow, ListInStream(items), sinks, keep_order=True)
+    assert sorted(calls) == list(range(20))
+    assert [item['b'] for item in sinks[0].items] == [i * 2 for i in range(20)]
+    assert [item['c'] for item in sinks[1].items] == [i * 2 + 1 for i in range(20)]
+
+
+def test_sharded_writers(tmp_path):
+    from dataflow.stream import CsvReadStream, CsvWriteStream
+
+    n = 300
+    write_input_csv(str(tmp_path / 'in.csv'), n)
+    expected = ['{},{}'.format(i, i * 11) for i in range(n)]
+
+    producer = dflow.ParallelProducer(num_workers=2, chunk_size=10, num_writers=3)
+    producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                     CsvWriteStream(str(tmp_path / 'out.csv'), ['a', 'c'], max_buf_bytes=256))
+    lines = []
+    for i in range(3):
+        part = read_output_csv(str(tmp_path / 'out-{:05d}.csv'.format(i)))
+        assert part[0] == 'a,c'
+        lines += part[1:]
+    assert sorted(lines) == sorted(expected)
+    assert not (tmp_path / 'out.csv').exists()
+
+    producer = dflow.ParallelProducer(num_workers=2, chunk_size=10, num_writers=3, merge_parts=True)
+    producer.produce(build_csv_flow(), CsvReadStream(str(tmp_path / 'in.csv')),
+                     CsvWriteStream(str(tmp_path / 'merged.csv'), ['a', 'c'], inc_id='id'))
+    lines = read_output_csv(str(tmp_path / 'merged.csv'))
+    assert lines[0] == 'id,a,c'
+    assert [line.split(',', 1)[0] for line in lines[1:]] == [str(i + 1) for i in range(n)]
+    assert sorted(line.split(',', 1)[1] for line in lines[1:]) == sorted(expected)
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name.startswith('merged')) == ['merged.csv']
@@ -0,0 +1,138 @@
+from dataflow.stream import CsvReadStream, CsvWriteStream
+
+
+def read_items(filename, **kwargs):
+    with CsvReadStream(filename, **kwargs) as ins:
+        return list(ins.iter_items())
+
+
+def test_csv_engines(tmp_path):
+    filename = str(tmp_path / 'plain.csv')
+    with open(filename, 'w') as f:
+        f.write('a,b,c\n1,2,3\n4,,6\nx y,z,\n')
+
+    expected = [dict(a='1', b='2', c='3'), dict(a='4', b='', c='6'), dict(a='x y', b='z', c='')]
+    assert read_items(filename, engine='regex') == expected
+    assert read_items(filename, engine='csv', buffer_size=16) == expected
+
+    filename = str(tmp_path / 'quoted.csv')
+    with open(filename, 'w') as f:
+        f.write('a;b\n"1;2";"multi\nline"\n3;4\n')
+
+    assert read_items(filename, sep=';', engine='csv') == [dict(a='1;2', b='multi\nline'), dict(a='3', b='4')]
+
+    # the regex engine stays the default, for separators the csv module can
+    # not handle and for quotes kept in the values
+    filename = str(tmp_path / 'legacy.csv')
+    with open(filename, 'w') as f:
+        f.write("a::b\n'x::y'::2\n")
+
+    assert read_items(filename, sep='::') == [dict(a="'x::y'", b='2')]
+
+
+def test_csv_indices(tmp_path):
+    filename = str(tmp_path / 'gaps.csv')
+    with open(filename, 'w') as f:
+        f.write('a,b\n')
+        for i in range(30):
+            f.write('{},{}\n'.format(i, i * 2) if i % 7 != 3 else '\n')
+
+    # split and unsplit reads number rows alike, blank lines leave gaps
+    with CsvReadStream(filename, engine='csv') as ins:
+        indexed = list(ins.iter_indexed_items())
+        assert [i for i, _ in indexed] == [i for i in range(30) if i % 7 != 3]
+        assert all(item == dict(a=str(i), b=str(i * 2)) for i, item in indexed)
+        assert [pair for shard in ins.shards(3) for pair in ins.iter_shard(shard)] == indexed
+        assert list(ins.iter_items()) == [item for _, item in indexed]
+
+    # shards decode CRLF lines like the text-mode reader does
+    filename = str(tmp_path / 'crlf.csv')
+    with open(filename, 'wb') as f:
+        f.write(b'a,b\r\n' + b''.join('{},{}\r\n'.format(i, i * 2).encode() for i in range(30)))
+
+    expected = [(i, dict(a=str(i), b=str(i * 2))) for i in range(30)]
+    for engine in ('regex', 'csv'):
+        with CsvReadStream(filename, engine=engine) as ins:
+            assert list(ins.iter_indexed_items()) == expected
+            assert [pair for shard in ins.shards(3) for pair in ins.iter_shard(shard)] == expected
+
+
+def test_csv_round_trip(tmp_path):
+    filename = str(tmp_path / 'out' / 'data.csv')
+
+    with CsvWriteStream(filename, ['a', 'b'], inc_id='id', max_buf_size=2) as ous:
+        for i in range(5):
+            ous.put_item(dict(a=i, b=i * 2))
+
+    assert read_items(filename) == [dict(id=str(i + 1), a=str(i), b=str(i * 2)) for i in range(5)]
+
+
+def test_record_streams(tmp_path):
+    from dataflow.stream import RecordReadStream, RecordWriteStream
+
+    filename = str(tmp_path / 'data.rec')
+    items = [dict(a=i, b='x' * i, c=[i, i * 0.5], d=None) for i in range(50)]
+
+    ous = RecordWriteStream(filename, ['a', 'b', 'c', 'd'], block_size=7)
+    with ous:
+        for item in items[:30]:
+            ous.put_item(item)
+    with ous:
+        for item in items[30:]:
+            ous.put_item(item)
+
+    ins = RecordReadStream(filename)
+    with ins:
+        assert list(ins.iter_items()) == items
+
+    shards = ins.shards(4)
+    assert [shard.start for shard in shards] == [0, 14, 28, 37]
+    with ins:
+        pairs = [pair for shard in shards for pair in ins.iter_shard(shard)]
+    assert pairs == list(enumerate(items))
+
+
+def test_compressed_csv(tmp_path):
+    import gzip
+    from dataflow.compression import open_compressed
+
+    items = [dict(a=str(i), b='x' * (i % 7)) for i in range(2000)]
+    for ext in ('.gz', '.bz2', '.xz'):
+        filename = str(tmp_path / ('data.csv' + ext))
+        with CsvWriteStream(filename, ['a', 'b']) as ous:
+            for item in items:
+                ous.put_item(item)
+        assert read_items(filename, engine='csv') == items
+        assert read_items(filename, engine='regex') == items
+
+    # small blocks are written as concatenated members
+    filename = str(tmp_path / 'blocks.txt.gz')
+    text = ''.join('line {}\n'.format(i) for i in range(10000))
+    with open_compressed(filename, 'w', block_size=1000, threads=3) as f:
+        f.write(text)
+    with gzip.open(filename, 'rt') as f:
+        assert f.read() == text
+    with open_compressed(filename) as f:
+        assert f.read() == text
+
+    # a compressed input is a single shard, numbered like the plain file
+    filename = str(tmp_path / 'data.csv.gz')
+    with CsvReadStream(filename) as ins:
+        shards = ins.shards(4)
+        assert len(shards) == 1 and shards[0].count is None
+        assert [item for _, item in ins.iter_shard(shards[0])] == items
+
+    # resuming appends members after the checkpoint
+    filename = str(tmp_path / 'resumed.csv.gz')
+    ous = CsvWriteStream(filename, ['a', 'b'])
+    with ous:
+        for item in items[:10]:
+            ous.put_item(item)
+        state = ous.checkpoint()
+        for item in items[10:20]:
+            ous.put_item(item)
+    ous.resume(state)
+    with ous:
+        for item in items[10:30]:
+            ous.put_item(item)
+    assert read_items(filename) == items[:30]